@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# 2023 KDigital
+# Замеры скорости поиска и конфигурирования датчиков 415М-ДИ на имитаторах Modbus TCP и RTU
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import socket
+import select
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from threading import Thread, Lock
+import modbus_tk.defines as mb_def
+import modbus_tk.modbus as mb
+import modbus_tk.modbus_rtu as mb_rtu
+import modbus_tk.modbus_tcp as mb_tcp
+import main
+
+
+class SensorBank(mb.Databank):
+    """
+    Набор имитируемых датчиков 415М-ДИ: регистр 249 хранит адрес, запись в него переадресует датчик.
+    latency - задержка ответа в секундах, loss - доля запросов, оставшихся без ответа
+    """
+    def __init__(self, slaves, latency=0.0, loss=0.0, seed=0):
+        super(SensorBank, self).__init__(error_on_missing_slave=False)
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        for slave in slaves:
+            self.add_sensor(slave)
+
+    def add_sensor(self, slave):
+        sensor = self.add_slave(slave)
+        sensor.add_block("holding", mb_def.HOLDING_REGISTERS, 0, 256)
+        sensor.add_block("input", mb_def.ANALOG_INPUTS, 0, 16)
+        sensor.set_values("holding", 249, slave)
+
+    def sensors(self):
+        with self.lock:
+            return sorted(self._slaves)
+
+    def handle_request(self, query, request):
+        with self.lock:
+            if self.loss and self.random.random() < self.loss:
+                return ""
+            response = super(SensorBank, self).handle_request(query, request)
+            try:
+                slave, pdu = query.parse_request(request)
+            except mb.ModbusInvalidRequestError:
+                return response
+            if response and slave in self._slaves and pdu[0] == mb_def.WRITE_SINGLE_REGISTER and \
+                    int.from_bytes(pdu[1:3], "big") == 249:
+                self._slaves[int.from_bytes(pdu[3:5], "big")] = self._slaves.pop(slave)
+        if self.latency:
+            time.sleep(self.latency)
+        return response
+
+
+class TcpSimulator(object):
+    """
+    Имитатор шлюза Modbus TCP на свободном локальном порту
+    """
+    def __init__(self, bank):
+        self.bank = bank
+        self.host = "127.0.0.1"
+        self.port = free_port()
+        self.server = mb_tcp.TcpServer(port=self.port, address=self.host, databank=bank)
+        self.server.start()
+        # Сервер открывает порт в своем потоке - ждем, пока он начнет принимать подключения
+        deadline = time.monotonic() + 5.0
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((self.host, self.port), 0.1).close()
+                break
+            except OSError:
+                time.sleep(0.01)
+
+    def stop(self):
+        self.server.stop()
+
+
+class RtuSimulator(object):
+    """
+    Имитатор шины Modbus RTU на паре псевдотерминалов (только POSIX).
+    Ответ задерживается на время передачи кадров на скорости baudrate.
+    По адресам из collisions отвечают два датчика: их кадры накладываются, портя байты или удлиняя ответ.
+    strict - на запрос, отправленный на другой скорости, приходит мусор, как на настоящей линии
+    """
+    def __init__(self, bank, baudrate=19200, collisions=(), seed=0, strict=False):
+        import tty
+        self.bank = bank
+        self.baudrate = baudrate
+        self.strict = strict
+        self.collisions = set(collisions)
+        self.random = random.Random(seed)
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        char_time = 11.0 / self.baudrate
+        inter_frame = max(0.002, main.rtu_timing(self.baudrate)[1])
+        while self.running:
+            if not select.select([self.master_fd], [], [], 0.1)[0]:
+                continue
+            request = os.read(self.master_fd, 256)
+            while select.select([self.master_fd], [], [], inter_frame)[0]:
+                request += os.read(self.master_fd, 256)
+            if self.strict and not self.speed_matches():
+                os.write(self.master_fd, b"\xff\x13")
+                continue
+            response = self.bank.handle_request(mb_rtu.RtuQuery(), request)
+            if response and request[0] in self.collisions:
+                response = self.collide(response)
+            if response:
+                time.sleep((len(request) + len(response)) * char_time)
+                os.write(self.master_fd, response)
+
+    def speed_matches(self):
+        import termios
+        return termios.tcgetattr(self.slave_fd)[5] == getattr(termios, "B{0}".format(self.baudrate), None)
+
+    def collide(self, response):
+        # Второй датчик начинает передачу с задержкой в shift символов
+        shift = self.random.randrange(len(response))
+        if not shift:
+            return response
+        if self.random.random() < 0.5:
+            return response[:shift] + bytes(byte & self.random.randrange(256) for byte in response[shift:])
+        return response + response[-shift:]
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def sparse_population(count, seed=0):
+    """
+    Случайные адреса count датчиков из диапазона 1..247
+    """
+    return sorted(random.Random(seed).sample(range(1, 248), count))
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(percent / 100.0 * len(ordered))) - 1))]
+
+
+def timed(function):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    return time.perf_counter() - start, result
+
+
+def bench_port_scan(args, repeat):
+    sim = TcpSimulator(SensorBank([1]))
+    try:
+        ports = range(max(1, sim.port - args.scan_width // 2), min(65536, sim.port + args.scan_width // 2))
+        runs = [timed(lambda: main.scan_ports(sim.host, ports)) for _ in range(repeat)]
+        return [duration for duration, _ in runs], {"ports": len(ports),
+                                                    "found": all(sim.port in found for _, found in runs)}
+    finally:
+        sim.stop()
+
+
+def bench_tcp_discovery(args, repeat):
+    population = sparse_population(args.population, args.seed)
+    sim = TcpSimulator(SensorBank(population, args.latency, args.loss, args.seed))
+    try:
+        runs = [timed(lambda: main.TcpDevice(sim.host, sim.port).slaves) for _ in range(repeat)]
+        return [duration for duration, _ in runs], {"population": population,
+                                                    "complete": sum(found == population for _, found in runs)}
+    finally:
+        sim.stop()
+
+
+def bench_rtu_discovery(args, repeat):
+    population = sparse_population(args.population, args.seed)
+    sim = RtuSimulator(SensorBank(population, args.latency, args.loss, args.seed), args.baudrate)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            port_obj = main.Port(sim.port_name)
+        port_obj.baudrate = args.baudrate
+        runs = [timed(lambda: main.Device(port_obj).slaves) for _ in range(repeat)]
+        port_obj.close()
+        return [duration for duration, _ in runs], {"population": population,
+                                                    "complete": sum(found == population for _, found in runs)}
+    finally:
+        sim.stop()
+
+
+def bench_rtu_collisions(args, repeat):
+    """
+    Поиск на шине, где --collisions адресов заняты двумя датчиками сразу
+    """
+    population = sparse_population(args.population, args.seed)
+    collisions = population[:args.collisions]
+    sim = RtuSimulator(SensorBank(population, args.latency, args.loss, args.seed), args.baudrate, collisions,
+                       args.seed)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            port_obj = main.Port(sim.port_name)
+        port_obj.baudrate = args.baudrate
+        runs = [timed(lambda: main.Device(port_obj)) for _ in range(repeat)]
+        port_obj.close()
+        return [duration for duration, _ in runs], {
+            "population": population, "collisions": collisions,
+            "detected": sum(device.collisions == collisions for _, device in runs),
+            "clean": sum(device.slaves == population[args.collisions:] for _, device in runs)}
+    finally:
+        sim.stop()
+
+
+def bench_tcp_write(args, repeat):
+    bank = SensorBank([1], args.latency, args.loss, args.seed)
+    sim = TcpSimulator(bank)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            device = main.TcpDevice(sim.host, sim.port, 1)
+        durations = []
+        ok = 0
+        for num in range(repeat):
+            new_address = 2 if device.slave == 1 else 1
+            duration, _ = timed(lambda: device.write_slave(new_address))
+            durations.append(duration)
+            ok += bank.sensors() == [new_address] and device.slave == new_address
+        device.close()
+        return durations, {"verified": ok}
+    finally:
+        sim.stop()
+
+
+def bench_batch(args, repeat):
+    durations = []
+    extra = {"gateways": args.gateways, "sensors": args.gateways * args.population, "rows_per_sec": []}
+    for num in range(repeat):
+        population = sparse_population(args.population, args.seed + num)
+        sims = [TcpSimulator(SensorBank(population, args.latency, args.loss, args.seed))
+                for _ in range(args.gateways)]
+        try:
+            manifest = []
+            free = [slave for slave in range(1, 248) if slave not in population]
+            for sim in sims:
+                for slave, new_address in zip(population, free):
+                    manifest.append({"row": len(manifest) + 1, "transport": "tcp",
+                                     "endpoint": "{0}:{1}".format(sim.host, sim.port),
+                                     "address": slave, "new_address": new_address})
+            result_path = os.path.join(args.workdir, "benchmark_batch.csv")
+            duration, statuses = timed(lambda: main.batch_readdress(manifest, result_path))
+            durations.append(duration)
+            extra["rows_per_sec"].append(len(manifest) / duration)
+            extra["ok"] = statuses.get("ok", 0)
+        finally:
+            for sim in sims:
+                sim.stop()
+    return durations, extra
+
+
+def bench_replay(args, repeat):
+    """
+    Поиск датчиков на записанном обмене (--replay): шлюз или COM порт воспроизводятся с ускорением --replay-speed
+    """
+    replay = main.CaptureReplay(args.replay, args.replay_channel, args.replay_speed)
+    durations = []
+    found = []
+    for _ in range(repeat):
+        main.link_estimators.clear()
+        if replay.tcp:
+            gateway = main.ReplayGateway(replay)
+            try:
+                duration, device = timed(lambda: main.TcpDevice(gateway.host, gateway.port))
+                device.close()
+            finally:
+                gateway.stop()
+        else:
+            duration, device = timed(lambda: main.Device(main.ReplaySerial(replay)))
+        durations.append(duration)
+        found.append(device.slaves)
+    return durations, {"channel": replay.label, "speed": args.replay_speed, "found": found[-1],
+                       "stable": all(slaves == found[0] for slaves in found)}
+
+
+# Модули, которые main загружает только по необходимости (см. cold_start)
+DEFERRED_MODULES = ("asyncio", "concurrent.futures", "hashlib", "http.server", "keyboard", "serial.tools.list_ports")
+
+
+def bench_cold_start(args, repeat):
+    """
+    Холодный запуск: переадресация одного датчика подкомандой в новом процессе (python -m main readdress tcp)
+    против имитатора шлюза, каждый раз с пустыми кэшем и инвентарем. Отдельно - запуск интерпретатора,
+    импорт main и вывод справки при запуске скриптом и модулем (модуль берет байт-код из __pycache__)
+    """
+    bank = SensorBank([1], args.latency, args.loss, args.seed)
+    sim = TcpSimulator(bank)
+    root = os.path.dirname(os.path.abspath(main.__file__))
+
+    def launch(argv, home):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable] + argv, cwd=root, env=dict(os.environ, HOME=home, USERPROFILE=home),
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start, process.returncode
+
+    try:
+        durations = []
+        ok = 0
+        for _ in range(repeat):
+            address = bank.sensors()[0]
+            with tempfile.TemporaryDirectory(dir=args.workdir) as home:
+                duration, code = launch(["-m", "main", "readdress", "tcp", "{0}:{1}".format(sim.host, sim.port),
+                                         str(address), str(3 - address)], home)
+            durations.append(duration)
+            ok += code == 0 and bank.sensors() == [3 - address]
+        with tempfile.TemporaryDirectory(dir=args.workdir) as home:
+            startup = {name: percentile([launch(argv, home)[0] for _ in range(repeat)], 50)
+                       for name, argv in (("python", ["-c", "pass"]), ("import", ["-c", "import main"]),
+                                          ("script_help", ["main.py", "-h"]), ("module_help", ["-m", "main", "-h"]))}
+        script = "import sys, main; print(' '.join(name for name in {0!r} if name in sys.modules))"
+        loaded = subprocess.check_output([sys.executable, "-c", script.format(DEFERRED_MODULES)],
+                                         cwd=root).decode().split()
+        return durations, {"verified": ok, "startup_p50": startup,
+                           "deferred": [name for name in DEFERRED_MODULES if name not in loaded]}
+    finally:
+        sim.stop()
+
+
+SCENARIOS = [
+    ("port_scan", bench_port_scan),
+    ("tcp_discovery", bench_tcp_discovery),
+    ("rtu_discovery", bench_rtu_discovery),
+    ("rtu_collisions", bench_rtu_collisions),
+    ("tcp_write", bench_tcp_write),
+    ("batch", bench_batch),
+    ("replay", bench_replay),
+    ("cold_start", bench_cold_start),
+]
+
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args):
+    report = {"version": version(), "time": time.time(), "python": platform.python_version(),
+              "platform": platform.platform(), "params": dict(vars(args)), "scenarios": {}}
+    for name, scenario in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        if name in ("rtu_discovery", "rtu_collisions") and os.name != "posix":
+            continue
+        if name == "replay" and not args.replay:
+            continue
+        print("Сценарий", name, end="", flush=True)
+        durations, extra = scenario(args, args.repeat)
+        report["scenarios"][name] = {"runs": len(durations), "p50": percentile(durations, 50),
+                                     "p95": percentile(durations, 95), "p99": percentile(durations, 99),
+                                     "max": max(durations), "extra": extra}
+        print(": p50 {0:.3f} с, p95 {1:.3f} с, p99 {2:.3f} с".format(
+            report["scenarios"][name]["p50"], report["scenarios"][name]["p95"], report["scenarios"][name]["p99"]))
+    return report
+
+
+def benchmark_main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры скорости на имитаторах датчиков 415М-ДИ")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="файл результатов (JSON)")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="число повторов каждого сценария")
+    parser.add_argument("-s", "--scenarios", nargs="*", choices=[name for name, _ in SCENARIOS],
+                        help="запускаемые сценарии (по умолчанию все)")
+    parser.add_argument("--population", type=int, default=5, help="число датчиков на шине")
+    parser.add_argument("--collisions", type=int, default=1, help="число адресов с двумя датчиками на шине RTU")
+    parser.add_argument("--gateways", type=int, default=4, help="число шлюзов в пакетном сценарии")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа датчика, с")
+    parser.add_argument("--loss", type=float, default=0.0, help="доля потерянных ответов")
+    parser.add_argument("--baudrate", type=int, default=19200, help="скорость имитатора RTU")
+    parser.add_argument("--scan-width", type=int, default=2000, help="ширина диапазона поиска портов")
+    parser.add_argument("--seed", type=int, default=0, help="начальное значение генератора случайных чисел")
+    parser.add_argument("--workdir", default=".", help="каталог для временных файлов")
+    parser.add_argument("--replay", help="файл записи кадров (--capture) для сценария replay")
+    parser.add_argument("--replay-channel", help="канал записи, например tcp://10.0.0.5:502 (по умолчанию первый)")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="ускорение воспроизведения (0 - без задержек)")
+    args = parser.parse_args(argv)
+    report = run(args)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    main.border_print("Результаты сохранены в " + args.output, "#")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_main())
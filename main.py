@@ -3,68 +3,1041 @@
 # 2023 KDigital
 # Программа для конфигурирования датчика давления ООО"Датчики и системы" 415М-ДИ
 
+import os
+import sys
+import csv
+import json
+import argparse
+import errno
+import ipaddress
+import signal
 import socket
+import select
+import struct
+import time
+import heapq
+import mmap
+from collections import deque, OrderedDict
+from array import array
+from contextlib import contextmanager, nullcontext
 import modbus_tk.exceptions
+from modbus_tk.hooks import install_hook
 import serial
-from serial.tools import list_ports
 import serial.serialutil
 import modbus_tk.defines as mb_def
 import modbus_tk.modbus_rtu as mb_rtu
 import modbus_tk.modbus_tcp as mb_tcp
-import keyboard
-from threading import Thread
+try:
+    import termios
+except ImportError:
+    termios = None
+from threading import Thread, Lock, RLock, Event, BoundedSemaphore, Condition
 import re
+# asyncio, concurrent.futures, hashlib, http.server, keyboard и serial.tools.list_ports загружаются там, где нужны:
+# подкоманды и меню не платят при запуске за то, чем не пользуются
 
 sock = None
 port_obj = None
-port_search = False
+pool = None
+cache = None
+metrics = None
+capture = None
+inventory = None
+
+# Карта регистров 415М-ДИ: (имя, таблица, адрес, формат struct).
+# Формат "H"/"h" - один регистр, "I"/"i"/"f" - два регистра, старшее слово первым.
+# Дополняется из JSON файла через load_register_map()
+REGISTER_MAP = [
+    ("slave_address", "holding", 249, "H"),
+]
 
 
 class _RangeError(Exception):
     pass
 
 
+class CancelToken(object):
+    """
+    Общий признак прерывания для циклов поиска, записи и опроса.
+    Взводится по Esc, Ctrl+C (см. watch_abort) или вызовом cancel()
+    """
+    def __init__(self):
+        self.event = Event()
+        self.reason = None
+        self.busy = 0
+        self.lock = Lock()
+        # Клавиша прерывания для подсказок: Esc, только если watch_abort перехватил клавиатуру
+        self.key = "Ctrl+C"
+
+    def cancel(self, reason="cancel"):
+        self.reason = reason
+        self.event.set()
+
+    def interrupt(self, reason):
+        """
+        Прерывание от пользователя действует только во время операции.
+        Возвращаем False, если прерывать нечего
+        """
+        if not self.busy:
+            return False
+        self.cancel(reason)
+        return True
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
+
+    @contextmanager
+    def running(self):
+        """
+        Операция, которую можно прервать: на входе снимаем прерывание, оставшееся от прошлой
+        """
+        with self.lock:
+            if not self.busy:
+                self.event.clear()
+                self.reason = None
+            self.busy += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.busy -= 1
+
+
+abort = CancelToken()
+
+
 class Sock(socket.socket):
     """
-    Класс для объекта TCP порта
+    Класс для объекта TCP порта.
+    Таймаут подключения берется из общей с PortScanner оценки времени установления соединения с хостом
     """
-    def __init__(self, host, port, test=False):
+    def __init__(self, host, port):
         super(Sock, self).__init__(socket.AF_INET, socket.SOCK_STREAM)
+        # Запросы Modbus короткие: без Нагла запрос не ждет отложенного ACK на прошлый, оставшийся без ответа
+        self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.host = host
         self.port = port
-        self.test = test
-        self.settimeout(0.25)
+        self.rtt = connect_rtt(host)
         self.is_connect = False
         self.try_connect()
 
     def try_connect(self):
-        if self.test:
-            self.settimeout(0.001)
-            try:
-                if self.connect_ex((self.host, self.port)):
-                    self.is_connect = False
-                else:
-                    print()
-                    border_print("Подключено к " + self.host + ":" + str(self.port), "#")
-                    self.is_connect = True
-            except socket.gaierror:
-                self.is_connect = False
+        # Не короче прежних 0.25 с: разовое подключение не должно срываться из-за дрожания быстрого канала
+        self.settimeout(max(0.25, self.rtt.timeout()))
+        start = time.monotonic()
+        try:
+            result = self.connect_ex((self.host, self.port))
+        except socket.gaierror:
+            result = None
+        if result == 0:
+            self.rtt.sample(time.monotonic() - start)
+            border_print("Подключено к " + self.host + ":" + str(self.port), "#")
+            self.is_connect = True
         else:
-            try:
-                if self.connect_ex((self.host, self.port)):
-                    border_print("Подключиться к " + self.host + ":" + str(self.port) + " не удалось", "!")
-                    self.is_connect = False
-                else:
-                    border_print("Подключено к " + self.host + ":" + str(self.port), "#")
-                    self.is_connect = True
-            except socket.gaierror:
-                border_print("Подключиться к " + self.host + ":" + str(self.port) + " не удалось", "!")
-                self.is_connect = False
+            if result in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ETIMEDOUT, errno.EINPROGRESS):
+                # Не успели за таймаут - следующая попытка ждет дольше
+                self.rtt.backoff()
+            border_print("Подключиться к " + self.host + ":" + str(self.port) + " не удалось", "!")
+            self.is_connect = False
+        # Таймаут обмена задает TcpDevice, работающий через это подключение
+        self.settimeout(0.25)
 
     def check_connect(self):
         return self.is_connect
 
 
+class RttEstimator(object):
+    """
+    Оценка времени отклика канала по Якобсону/Карелсу: таймаут = srtt + max(granularity, 4 * rttvar)
+    в пределах [minimum, maximum]. granularity - запас на дрожание планировщика потоков, когда разброс
+    на ровном канале сходится к нулю (как G в RFC 6298).
+    Пока удачных ответов не было, каждый таймаут удваивает ожидание, чтобы не считать медленный канал мертвым
+    """
+    def __init__(self, initial, minimum, maximum, granularity=0.01):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.granularity = granularity
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.maximum, max(self.minimum, self.srtt + max(self.granularity, 4 * self.rttvar)))
+
+    def backoff(self):
+        if self.srtt is None:
+            self.rto = min(self.maximum, self.rto * 2)
+
+    def timeout(self):
+        return self.rto
+
+
+link_estimators = {}
+link_lock = Lock()
+
+
+def link_rtt(label, initial, minimum, maximum):
+    """
+    Общая на весь сеанс оценка времени отклика канала label (см. bus_label)
+    """
+    with link_lock:
+        if label not in link_estimators:
+            link_estimators[label] = RttEstimator(initial, minimum, maximum)
+        return link_estimators[label]
+
+
+def connect_rtt(host, initial=1.0, minimum=0.05, maximum=5.0):
+    """
+    Оценка времени установления TCP соединения с хостом: общая для PortScanner, Sock и TcpDevice
+    """
+    return link_rtt("connect://" + host, initial, minimum, maximum)
+
+
+class PortScanner(object):
+    """
+    Асинхронный поиск открытых TCP портов в заданном диапазоне.
+    Одновременно держит до concurrency неблокирующих подключений,
+    таймаут подстраивается под измеренное время отклика хоста
+    """
+    def __init__(self, host, ports, concurrency=256, timeout=1.0, min_timeout=0.05, stop=None, on_open=None):
+        self.host = host
+        self.ports = list(ports)
+        self.concurrency = concurrency
+        self.max_timeout = timeout
+        self.stop = stop
+        self.on_open = on_open
+        # Время установления соединения с хостом запоминаем между поисками
+        self.rtt = connect_rtt(host, timeout, min_timeout, timeout)
+        self.open_ports = []
+
+    def stopped(self):
+        return self.stop is not None and self.stop()
+
+    def get_timeout(self):
+        return self.rtt.timeout()
+
+    async def probe(self, port, timeout):
+        """
+        Возвращает True - порт открыт, False - закрыт, None - ответа нет
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, port), timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ConnectionRefusedError:
+            # RST от хоста тоже дает время отклика
+            self.rtt.sample(loop.time() - start)
+            return False
+        except OSError:
+            return False
+        self.rtt.sample(loop.time() - start)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    def targets(self):
+        """
+        Проверяемые порты (или адреса host:port у GatewayScanner), выдаются по одному
+        """
+        return iter(self.ports)
+
+    def size(self):
+        return len(self.ports)
+
+    async def worker(self, queue, timeouts, retry_timeout=None):
+        # queue - общий для всех обработчиков итератор, следующий адрес берется только когда освободился обработчик
+        for port in queue:
+            if self.stopped():
+                break
+            timeout = self.get_timeout() if retry_timeout is None else retry_timeout
+            result = await self.probe(port, timeout)
+            if result:
+                self.open_ports.append(port)
+                if self.on_open is not None:
+                    self.on_open(port)
+            elif result is None:
+                timeouts[port] = timeout
+
+    def resolve(self):
+        try:
+            self.host = socket.gethostbyname(self.host)
+            return True
+        except socket.gaierror:
+            return False
+
+    async def run(self):
+        import asyncio
+        if not self.resolve():
+            return []
+        timeouts = {}
+        queue = self.targets()
+        await asyncio.gather(*[self.worker(queue, timeouts) for _ in range(min(self.concurrency, self.size()))])
+        # Повторно проверяем только порты, которые не ответили за таймаут меньше итогового,
+        # чтобы результат не зависел от того, когда оценка времени отклика устоялась
+        retry_timeout = min(self.max_timeout, 2 * self.get_timeout())
+        retry = sorted(port for port, timeout in timeouts.items() if timeout < retry_timeout)
+        if retry:
+            queue = iter(retry)
+            await asyncio.gather(*[self.worker(queue, {}, retry_timeout)
+                                   for _ in range(min(self.concurrency, len(retry)))])
+        self.open_ports.sort()
+        return self.open_ports
+
+
+class GatewayScanner(PortScanner):
+    """
+    Поиск шлюзов Modbus TCP в подсетях: порты проверяются сразу у тысяч хостов,
+    на открытый порт отправляется чтение регистра 249 (как в TcpDevice), любой ответ Modbus
+    подтверждает шлюз. Найденные шлюзы передаются в on_found по мере обнаружения.
+    Адреса host:port перебираются по ходу поиска, список всех адресов подсети не строится
+    """
+    def __init__(self, networks, ports=(502,), slave=1, concurrency=512, timeout=0.5, modbus_timeout=1.0,
+                 stop=None, on_found=None):
+        super(GatewayScanner, self).__init__(",".join(str(network) for network in networks), ports,
+                                             concurrency, timeout, stop=stop, on_open=self.report)
+        self.networks = [ipaddress.ip_network(network, strict=False) for network in networks]
+        self.slave = slave
+        self.modbus_timeout = modbus_timeout
+        self.on_found = on_found
+        self.gateways = {}
+
+    def resolve(self):
+        return True
+
+    def targets(self):
+        return ((str(host), port) for network in self.networks for host in network.hosts() for port in self.ports)
+
+    def size(self):
+        return gateway_targets(self.networks, self.ports)
+
+    def report(self, endpoint):
+        if self.on_found is not None:
+            self.on_found(endpoint + (self.gateways[endpoint],))
+
+    async def probe(self, endpoint, timeout):
+        import asyncio
+        host, port = endpoint
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ConnectionRefusedError:
+            self.rtt.sample(loop.time() - start)
+            return False
+        except OSError:
+            return False
+        self.rtt.sample(loop.time() - start)
+        try:
+            status = await self.modbus_probe(reader, writer)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        if status is None:
+            # Порт открыт, но это не Modbus
+            return False
+        self.gateways[endpoint] = status
+        return True
+
+    async def modbus_probe(self, reader, writer):
+        """
+        Возвращаем "sensor" - датчик ответил своим адресом, "modbus" - другой ответ Modbus, None - ответа нет
+        """
+        import asyncio
+        writer.write(mbap_request(1, self.slave))
+        try:
+            header = await asyncio.wait_for(reader.readexactly(7), self.modbus_timeout)
+            tid, protocol, length, _ = struct.unpack(">HHHB", header)
+            if tid != 1 or protocol != 0 or not 2 <= length <= 254:
+                return None
+            pdu = await asyncio.wait_for(reader.readexactly(length - 1), self.modbus_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            return None
+        return "sensor" if probe_reply(pdu, self.slave) == "ok" else "modbus"
+
+    async def run(self):
+        await super(GatewayScanner, self).run()
+        return [endpoint + (self.gateways[endpoint],)
+                for endpoint in sorted(self.open_ports, key=lambda item: (ipaddress.ip_address(item[0]), item[1]))]
+
+
+# Больше адресов host:port без подтверждения не проверяем (подсеть /16 на одном порту)
+GATEWAY_SCAN_LIMIT = 65536
+
+
+def gateway_targets(networks, ports):
+    """
+    Число адресов host:port поиска шлюзов (с адресами сети и широковещательным - оценка сверху)
+    """
+    return sum(ipaddress.ip_network(network, strict=False).num_addresses for network in networks) * len(ports)
+
+
+def discover_gateways(networks, ports=(502,), stop=None, on_found=None, **kwargs):
+    """
+    Возвращаем найденные шлюзы [(host, port, "sensor"/"modbus")], отсортированные по адресу
+    """
+    import asyncio
+    return asyncio.run(GatewayScanner(networks, ports, stop=stop, on_found=on_found, **kwargs).run())
+
+
+def mbap_request(tid, slave):
+    """
+    Кадр Modbus TCP: чтение регистра 249 датчика slave
+    """
+    return struct.pack(">HHHBBHH", tid, 0, 6, slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
+
+
+def probe_reply(pdu, slave):
+    """
+    Разбор ответа на чтение регистра 249: "ok" - датчик ответил своим адресом,
+    "gateway" - шлюз сообщил, что устройство за ним не ответило, "error" - иной ответ
+    """
+    if pdu[0] == mb_def.READ_HOLDING_REGISTERS and len(pdu) == 4 and struct.unpack(">H", pdu[2:4])[0] == slave:
+        return "ok"
+    if pdu[0] & 0x80 and len(pdu) > 1 and pdu[1] in (0x0A, 0x0B):
+        return "gateway"
+    return "error"
+
+
+def scan_ports(host, ports, stop=None, on_open=None, **kwargs):
+    """
+    Возвращаем отсортированный список открытых портов хоста
+    """
+    import asyncio
+    return asyncio.run(PortScanner(host, ports, stop=stop, on_open=on_open, **kwargs).run())
+
+
+def bus_label(master):
+    """
+    Имя шины для статистики: tcp://host:port или rtu://порт
+    """
+    if hasattr(master, "_host"):
+        return "tcp://{0}:{1}".format(master._host, master._port)
+    return "rtu://{0}".format(master._serial.port)
+
+
+class Metrics(object):
+    """
+    Статистика транзакций Modbus по (шина, адрес, функция): исходы, повторы и гистограмма задержек.
+    Пока глобальная metrics равна None, учет не ведется и не замедляет опрос
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.series = OrderedDict()
+
+    def record(self, bus, slave, function, latency, outcome):
+        with self.lock:
+            series = self.series.get((bus, slave, function))
+            if series is None:
+                series = self.series[(bus, slave, function)] = {
+                    "outcomes": {}, "retries": 0, "failed": False, "count": 0, "sum": 0.0,
+                    "buckets": array("L", bytes(array("L").itemsize * len(self.buckets)))}
+            series["outcomes"][outcome] = series["outcomes"].get(outcome, 0) + 1
+            # Запрос после неудачного к тому же датчику той же функцией считаем повтором
+            if series["failed"]:
+                series["retries"] += 1
+            series["failed"] = outcome != "ok"
+            series["count"] += 1
+            series["sum"] += latency
+            for num, bound in enumerate(self.buckets):
+                if latency <= bound:
+                    series["buckets"][num] += 1
+                    break
+
+    def observe(self, master, call, args, kwargs):
+        """
+        Выполняем call(*args, **kwargs) - запрос execute - и учитываем его исход
+        """
+        slave = args[0] if args else kwargs.get("slave")
+        function = args[1] if len(args) > 1 else kwargs.get("function_code")
+        start = time.perf_counter()
+        try:
+            result = call(*args, **kwargs)
+        except Exception as err:
+            self.record(bus_label(master), slave, function, time.perf_counter() - start, classify_error(err))
+            raise
+        self.record(bus_label(master), slave, function, time.perf_counter() - start, "ok")
+        return result
+
+    def prometheus(self):
+        lines = ["# TYPE modbus_transactions_total counter", "# TYPE modbus_retries_total counter",
+                 "# TYPE modbus_latency_seconds histogram"]
+        with self.lock:
+            for (bus, slave, function), series in self.series.items():
+                labels = 'bus="{0}",slave="{1}",function="{2}"'.format(bus, slave, function)
+                for outcome, count in sorted(series["outcomes"].items()):
+                    lines.append('modbus_transactions_total{{{0},outcome="{1}"}} {2}'.format(labels, outcome, count))
+                lines.append("modbus_retries_total{{{0}}} {1}".format(labels, series["retries"]))
+                total = 0
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    total += count
+                    lines.append('modbus_latency_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound, total))
+                lines.append('modbus_latency_seconds_bucket{{{0},le="+Inf"}} {1}'.format(labels, series["count"]))
+                lines.append("modbus_latency_seconds_sum{{{0}}} {1:.6f}".format(labels, series["sum"]))
+                lines.append("modbus_latency_seconds_count{{{0}}} {1}".format(labels, series["count"]))
+        return "\n".join(lines) + "\n"
+
+    def to_list(self):
+        with self.lock:
+            return [{"bus": bus, "slave": slave, "function": function, "outcomes": dict(series["outcomes"]),
+                     "retries": series["retries"], "count": series["count"], "sum": series["sum"],
+                     "buckets": dict(zip((str(bound) for bound in self.buckets), series["buckets"]))}
+                    for (bus, slave, function), series in self.series.items()]
+
+    def json_lines(self):
+        return "".join(json.dumps(item) + "\n" for item in self.to_list()) or "\n"
+
+    def save(self, path):
+        """
+        Сохраняем статистику: .prom/.txt - текстовый формат Prometheus, иначе JSON lines
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.prometheus() if path.lower().endswith((".prom", ".txt")) else self.json_lines())
+
+
+def classify_error(err):
+    if isinstance(err, socket.timeout):
+        return "timeout"
+    if isinstance(err, mb_tcp.ModbusInvalidMbapError):
+        return "mbap"
+    if isinstance(err, modbus_tk.exceptions.ModbusInvalidResponseError):
+        if "CRC" in str(err):
+            return "crc"
+        # Пустой ответ на RTU означает, что датчик промолчал до таймаута
+        if str(err).endswith(" 0") or "only 0 bytes" in str(err):
+            return "timeout"
+        return "invalid"
+    if isinstance(err, modbus_tk.exceptions.ModbusError):
+        return "exception"
+    return "error"
+
+
+def enable_metrics():
+    global metrics
+    if metrics is None:
+        metrics = Metrics()
+    return metrics
+
+
+CAPTURE_MAGIC = b"415D"
+CAPTURE_CHANNEL = 0
+CAPTURE_TX = 1
+CAPTURE_RX = 2
+# Запись кадра: тип, канал, длина, время в нс от эпохи; затем байты кадра (для CAPTURE_CHANNEL - имя канала).
+# Номер канала 32-битный: номера не повторяются, сколько бы шин ни прошло через запись
+CAPTURE_RECORD = struct.Struct("<BIHQ")
+# Прежний формат с 8-битным номером канала - только для чтения
+CAPTURE_FORMATS = {CAPTURE_MAGIC: CAPTURE_RECORD, b"415C": struct.Struct("<BBHQ")}
+
+
+class FrameCapture(object):
+    """
+    Запись сырых кадров Modbus в двоичный файл только на дозапись.
+    Кадры копятся в памяти и пишутся пачками по buffer_size байт, чтобы не тормозить обмен.
+    Время - наносекунды от эпохи по счетчику perf_counter, привязанному к часам при открытии
+    """
+    def __init__(self, path, buffer_size=65536):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.channels = {}
+        # record() сбрасывает заполненный буфер через flush() под той же блокировкой
+        self.lock = RLock()
+        self.base = time.time_ns() - time.perf_counter_ns()
+        self.file = open(path, "ab+")
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        else:
+            self.file.seek(0)
+            magic = self.file.read(len(CAPTURE_MAGIC))
+            self.file.seek(0, os.SEEK_END)
+            if magic != CAPTURE_MAGIC:
+                self.file.close()
+                raise ValueError("Файл " + path + " не является записью кадров этого формата")
+
+    def record(self, label, kind, frame):
+        if not frame:
+            return
+        stamp = self.base + time.perf_counter_ns()
+        with self.lock:
+            channel = self.channels.get(label)
+            if channel is None:
+                channel = self.channels[label] = len(self.channels)
+                name = label.encode("utf-8")
+                self.buffer += CAPTURE_RECORD.pack(CAPTURE_CHANNEL, channel, len(name), stamp) + name
+            self.buffer += CAPTURE_RECORD.pack(kind, channel, len(frame), stamp)
+            self.buffer += frame
+            if len(self.buffer) >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.file.write(self.buffer)
+                self.file.flush()
+                self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_capture(path):
+    """
+    Читаем файл записи: список (время в секундах от эпохи, CAPTURE_TX/CAPTURE_RX, имя канала, кадр)
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    record = CAPTURE_FORMATS.get(data[:len(CAPTURE_MAGIC)])
+    if record is None:
+        raise ValueError("Файл " + path + " не является записью кадров")
+    frames = []
+    channels = {}
+    pos = len(CAPTURE_MAGIC)
+    while pos + record.size <= len(data):
+        kind, channel, length, stamp = record.unpack_from(data, pos)
+        pos += record.size
+        frame = data[pos:pos + length]
+        pos += length
+        if kind == CAPTURE_CHANNEL:
+            # Номера каналов назначаются заново при каждом дописывании файла
+            channels[channel] = frame.decode("utf-8")
+        else:
+            frames.append((stamp / 1e9, kind, channels.get(channel, str(channel)), frame))
+    return frames
+
+
+def capture_label(master):
+    """
+    Имя канала записи: как в статистике, для RTU со скоростью порта (rtu://порт@скорость)
+    """
+    if hasattr(master, "_serial"):
+        return "{0}@{1}".format(bus_label(master), master._serial.baudrate)
+    return bus_label(master)
+
+
+def capture_hook(kind):
+    def hook(args):
+        if capture is not None:
+            capture.record(capture_label(args[0]), kind, args[1])
+    return hook
+
+
+capture_hooks = False
+
+
+def enable_capture(path):
+    """
+    Включаем запись кадров всех TcpDevice и Device в файл path.
+    Если файл не открылся или записан в другом формате, работаем без записи
+    """
+    global capture, capture_hooks
+    if not capture_hooks:
+        install_hook("modbus_tcp.TcpMaster.before_send", capture_hook(CAPTURE_TX))
+        install_hook("modbus_tcp.TcpMaster.after_recv", capture_hook(CAPTURE_RX))
+        install_hook("modbus_rtu.RtuMaster.before_send", capture_hook(CAPTURE_TX))
+        install_hook("modbus_rtu.RtuMaster.after_recv", capture_hook(CAPTURE_RX))
+        capture_hooks = True
+    disable_capture()
+    try:
+        capture = FrameCapture(path)
+    except (OSError, ValueError) as err:
+        border_print("ERROR: запись кадров не включена: " + str(err), "!")
+    return capture
+
+
+def disable_capture():
+    global capture
+    if capture is not None:
+        capture.close()
+        capture = None
+
+
+class CaptureReplay(object):
+    """
+    Ответы одного канала записи: запрос -> очередь (ответ, задержка ответа).
+    Одинаковые запросы получают записанные ответы по кругу, запрос без записанного ответа - тишина.
+    speed - ускорение воспроизведения (1.0 - как было, 0 - без задержек)
+    """
+    def __init__(self, path, label=None, speed=1.0):
+        frames = read_capture(path)
+        labels = [frame_label for _, _, frame_label, _ in frames]
+        if label is None and labels:
+            label = labels[0]
+        self.label = label
+        self.tcp = label is not None and label.startswith("tcp://")
+        self.speed = speed
+        self.responses = {}
+        self.lock = Lock()
+        sent = {}
+        last = None
+        for stamp, kind, frame_label, frame in frames:
+            if frame_label != label:
+                continue
+            if kind == CAPTURE_TX:
+                last = (stamp, frame)
+                if self.tcp:
+                    sent[frame[:2]] = last
+            else:
+                # Ответ Modbus TCP находим по номеру транзакции, ответ RTU - ответ на последний запрос
+                request = sent.pop(frame[:2], None) if self.tcp else last
+                last = None
+                if request is not None:
+                    self.responses.setdefault(self.key(request[1]), deque()).append((frame, stamp - request[0]))
+
+    def key(self, request):
+        return request[2:] if self.tcp else request
+
+    def respond(self, request):
+        """
+        Возвращаем (ответ, задержка в секундах) или (None, 0.0)
+        """
+        with self.lock:
+            answers = self.responses.get(self.key(request))
+            if not answers:
+                return None, 0.0
+            response, delay = answers[0]
+            answers.rotate(-1)
+        if self.tcp:
+            response = request[:2] + response[2:]
+        return response, delay / self.speed if self.speed else 0.0
+
+
+class ReplayGateway(object):
+    """
+    Воспроизведение записанного шлюза Modbus TCP на локальном порту: с ним работают обычные Sock и TcpDevice.
+    Ответы уходят через записанную задержку после запроса, поэтому конвейерные запросы тоже воспроизводятся.
+    Тишину отмеряет таймаут клиента, ускорение ее не сокращает
+    """
+    def __init__(self, replay, host="127.0.0.1", port=0):
+        self.replay = replay
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(8)
+        self.host, self.port = self.server.getsockname()
+        self.running = True
+        self.thread = Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client):
+        buf = b""
+        due = []
+        seq = 0
+        try:
+            while self.running:
+                wait = max(0.0, due[0][0] - time.monotonic()) if due else 0.5
+                if select.select([client], [], [], wait)[0]:
+                    data = client.recv(4096)
+                    if not data:
+                        return
+                    buf += data
+                    while len(buf) >= 6 and len(buf) >= struct.unpack(">H", buf[4:6])[0] + 6:
+                        length = struct.unpack(">H", buf[4:6])[0] + 6
+                        request, buf = buf[:length], buf[length:]
+                        response, delay = self.replay.respond(request)
+                        if response is not None:
+                            seq += 1
+                            heapq.heappush(due, (time.monotonic() + delay, seq, response))
+                while due and due[0][0] <= time.monotonic():
+                    client.sendall(heapq.heappop(due)[2])
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+
+
+class ReplaySerial(serial.serialutil.SerialBase):
+    """
+    Воспроизведение записанного COM порта: объект вместо Port для Device.
+    Ответ становится доступен для чтения через записанную задержку после запроса,
+    тишина длится таймаут чтения, при ускорении - во столько же раз короче
+    """
+    def __init__(self, replay, port=None):
+        self.replay = replay
+        self.pending = b""
+        self.ready_at = 0.0
+        super(ReplaySerial, self).__init__()
+        name, _, baudrate = (replay.label or "rtu://replay")[len("rtu://"):].rpartition("@")
+        self.port = port or name or baudrate
+        if name and baudrate.isdigit():
+            self.baudrate = int(baudrate)
+        self.open()
+
+    def silence(self, timeout):
+        if timeout and self.replay.speed:
+            time.sleep(timeout / self.replay.speed)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self, force_update=False):
+        pass
+
+    @property
+    def in_waiting(self):
+        return len(self.pending) if time.monotonic() >= self.ready_at else 0
+
+    def reset_input_buffer(self):
+        self.pending = b""
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        response, delay = self.replay.respond(bytes(data))
+        self.pending = response or b""
+        self.ready_at = time.monotonic() + delay
+        return len(data)
+
+    def read(self, size=1):
+        if not self.pending:
+            self.silence(self.timeout)
+            return b""
+        wait = self.ready_at - time.monotonic()
+        if wait > 0:
+            if self.timeout is not None and wait > self.timeout / (self.replay.speed or 1.0):
+                self.silence(self.timeout)
+                return b""
+            time.sleep(wait)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def rtu_timing(baudrate, turnaround=0.02):
+    """
+    Времена Modbus RTU по скорости порта: межсимвольный интервал, межкадровый интервал
+    и ожидание ответа на чтение одного регистра (8 байт запроса, 7 байт ответа)
+    """
+    char_time = 11.0 / baudrate
+    if baudrate > 19200:
+        inter_char = 0.00075
+        inter_frame = 0.00175
+    else:
+        inter_char = 1.5 * char_time
+        inter_frame = 3.5 * char_time
+    response = (8 + 7) * char_time + inter_frame + turnaround
+    return inter_char, inter_frame, response
+
+
+def rtu_probe(master, slave):
+    """
+    Одиночный запрос регистра 249 через RtuMaster без повторов. Возвращаем:
+    "ok" - датчик ответил своим адресом, "error" - ответило другое устройство или ошибка Modbus,
+    "crc" - на линии были данные, но кадр битый или неполный,
+    "overlap" - после ответа пришли лишние байты (отвечали два передатчика сразу), "silent" - тишина
+    """
+    start = time.perf_counter()
+    result = _rtu_probe(master, slave)
+    if metrics is not None:
+        metrics.record(bus_label(master), slave, mb_def.READ_HOLDING_REGISTERS, time.perf_counter() - start,
+                       {"ok": "ok", "silent": "timeout", "crc": "crc", "overlap": "overlap",
+                        "error": "exception"}[result])
+    return result
+
+
+def _rtu_probe(master, slave):
+    query = master._make_query()
+    master._send(query.build_request(struct.pack(">BHH", mb_def.READ_HOLDING_REGISTERS, 249, 1), slave))
+    response = master._recv(7)
+    if not response:
+        return "silent"
+    # Хвост после кадра ждем один межкадровый интервал, только у ответивших адресов
+    time.sleep(rtu_timing(master._serial.baudrate)[1])
+    if master._serial.in_waiting:
+        master._serial.reset_input_buffer()
+        return "overlap"
+    try:
+        pdu = query.parse_response(response)
+    except modbus_tk.exceptions.ModbusInvalidResponseError:
+        return "crc"
+    if pdu[0] == mb_def.READ_HOLDING_REGISTERS and len(pdu) == 4 and struct.unpack(">H", pdu[2:4])[0] == slave:
+        return "ok"
+    return "error"
+
+
+def is_usb_serial(com_port):
+    description = com_port.description.lower()
+    return "ch340" in description or "serial" in description
+
+
+# Сколько запомненных адресов адаптера опрашивать при выборе порта (каждый молчащий стоит таймаут)
+PROBE_CACHED_SLAVES = 8
+
+
+def probe_slaves(port_name):
+    """
+    Адреса для проверки порта: запомненные для адаптера (на рабочей шине датчики редко стоят на адресе 1), затем 1
+    """
+    cached = cache.slaves(("rtu", adapter_id(port_name))) if cache is not None else []
+    return [slave for slave in cached[:PROBE_CACHED_SLAVES] if slave != 1] + [1]
+
+
+def probe_com_port(com_port, slaves=None, timeout=0.1):
+    """
+    Открываем COM порт и опрашиваем на нем адреса slaves (None - probe_slaves).
+    Устройство есть на адресе, если пришел целый кадр Modbus, в том числе ответ с кодом ошибки.
+    Возвращаем (порт, список ответивших адресов, время ответа) или None, если порт не открылся
+    """
+    if slaves is None:
+        slaves = probe_slaves(com_port.device)
+    baudrate, parity, stopbits = cached_framing(com_port.device) or (9600, serial.PARITY_NONE, 1)
+    try:
+        ser = serial.Serial(com_port.device, baudrate=baudrate, parity=parity, stopbits=stopbits, bytesize=8,
+                            timeout=timeout)
+    except serial.serialutil.SerialException:
+        return None
+    try:
+        master = mb_rtu.RtuMaster(ser)
+        master.set_timeout(timeout)
+        found = []
+        start = time.monotonic()
+        for slave in slaves:
+            if rtu_probe(master, slave) in ("ok", "error"):
+                found.append(slave)
+        return com_port, found, time.monotonic() - start
+    except serial.serialutil.SerialException:
+        return None
+    finally:
+        ser.close()
+
+
+def probe_com_ports(ports, slaves=None, timeout=0.1):
+    """
+    Параллельно опрашиваем все порты и возвращаем порты с ответившими датчиками,
+    лучшие первыми: больше датчиков, затем CH340/"serial" адаптеры, затем быстрее ответ
+    """
+    if not ports:
+        return []
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        results = list(pool.map(lambda com_port: probe_com_port(com_port, slaves, timeout), ports))
+    ranked = [result for result in results if result is not None and result[1]]
+    ranked.sort(key=lambda result: (-len(result[1]), not is_usb_serial(result[0]), result[2]))
+    return ranked
+
+
+# Скорости по убыванию распространенности, затем форматы кадра Modbus RTU (8N1, 8E1, 8O1, 8N2)
+FRAMING_BAUDRATES = (9600, 19200, 115200, 38400, 57600, 4800, 2400, 1200)
+FRAMING_FORMATS = ((serial.PARITY_NONE, 1), (serial.PARITY_EVEN, 1), (serial.PARITY_ODD, 1), (serial.PARITY_NONE, 2))
+# Ошибки установки неподдерживаемых адаптером настроек (на POSIX pyserial пропускает ошибку termios)
+FRAMING_ERRORS = (ValueError, serial.serialutil.SerialException) + ((termios.error,) if termios is not None else ())
+
+
+def cached_framing(port_name):
+    """
+    Запомненные для адаптера (скорость, четность, стоп-биты) или None
+    """
+    return cache.framing(adapter_id(port_name)) if cache is not None else None
+
+
+def framing_candidates(first=None):
+    """
+    Порядок перебора настроек порта: запомненные первыми, затем частые скорости
+    """
+    candidates = [(baudrate, parity, stopbits) for baudrate in FRAMING_BAUDRATES
+                  for parity, stopbits in FRAMING_FORMATS]
+    if first is not None and tuple(first) in candidates:
+        candidates.remove(tuple(first))
+        candidates.insert(0, tuple(first))
+    return candidates
+
+
+def sweep_framing(ser, slaves=(1,), first=None, stop=None):
+    """
+    Перебираем настройки открытого порта ser до первого правильного кадра Modbus от любого из slaves
+    (ответ с ошибкой Modbus тоже годится - кадр принят и CRC сошлась).
+    Порт остается на найденных настройках. Возвращаем (скорость, четность, стоп-биты) или None
+    """
+    stop = stop or abort
+    master = mb_rtu.RtuMaster(ser)
+    for baudrate, parity, stopbits in framing_candidates(first):
+        if stop.is_set():
+            break
+        try:
+            ser.baudrate, ser.parity, ser.stopbits = baudrate, parity, stopbits
+        except FRAMING_ERRORS:
+            continue
+        _, inter_frame, response = rtu_timing(baudrate)
+        master.set_timeout(response)
+        for slave in slaves:
+            time.sleep(inter_frame)
+            ser.reset_input_buffer()
+            if rtu_probe(master, slave) in ("ok", "error"):
+                return baudrate, parity, stopbits
+    return None
+
+
+def detect_framing(port_name, slaves=(1,), stop=None):
+    """
+    Автоопределение скорости и формата кадра на одном порту, результат запоминается для адаптера
+    """
+    try:
+        ser = serial.Serial(port_name, bytesize=8, timeout=0.1)
+    except serial.serialutil.SerialException:
+        return None
+    try:
+        framing = sweep_framing(ser, slaves, cached_framing(port_name), stop)
+    except serial.serialutil.SerialException:
+        framing = None
+    finally:
+        ser.close()
+    if framing is not None and cache is not None:
+        cache.set_framing(adapter_id(port_name), framing)
+    return framing
+
+
+def detect_framings(port_names, slaves=(1,), stop=None):
+    """
+    Параллельное автоопределение на нескольких адаптерах: {имя порта: настройки или None}
+    """
+    if not port_names:
+        return {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(port_names)) as executor:
+        return dict(zip(port_names, executor.map(lambda name: detect_framing(name, slaves, stop), port_names)))
+
+
 class Port(serial.Serial):
     """
     Класс для объекта COM порта
@@ -75,19 +1048,46 @@ class Port(serial.Serial):
         self.stopbits = 1
         self.bytesize = 8
         self.timeout = 0.1
-        if port is not None:
+        if isinstance(port, str):
+            self.port = port
+        elif port is not None:
             self.port = "COM{}".format(port)
+        if self.port is not None:
+            self.apply_framing(cached_framing(self.port))
         self.try_connect()
 
+    def apply_framing(self, framing):
+        if framing is not None:
+            self.baudrate, self.parity, self.stopbits = framing
+
     def try_connect(self):
         if self.port is None:
-            ports = list_ports.comports()
-            sort_ports = []
-            for com_port in ports:
-                if ("ch340" in com_port.description.lower()) or ("serial" in com_port.description.lower()):
-                    sort_ports.append(com_port)
-
-            for com_port in ports:
+            from serial.tools import list_ports
+            ports = remember_adapters(list_ports.comports())
+            ranked = probe_com_ports(ports, timeout=self.timeout)
+            if ranked:
+                border_print(["Датчики ответили на портах:"] +
+                             [com_port.device + " (адреса " + ", ".join(str(slave) for slave in found) + ")"
+                              for com_port, found, _ in ranked], "#")
+                self.port = ranked[0][0].device
+                self.apply_framing(cached_framing(self.port))
+                try:
+                    self.open()
+                    if self.check_ports():
+                        border_print("Подключено к " + self.port, "#")
+                        return
+                except serial.serialutil.SerialException:
+                    pass
+                self.port = None
+            elif ports and self.detect_port(ports):
+                return
+
+            sort_ports = []
+            for com_port in ports:
+                if is_usb_serial(com_port):
+                    sort_ports.append(com_port)
+
+            for com_port in ports:
                 if com_port not in sort_ports:
                     sort_ports.append(com_port)
 
@@ -117,321 +1117,2618 @@ class Port(serial.Serial):
     def check_ports(self):
         return self.is_open
 
+    def detect_port(self, ports, slaves=(1,)):
+        """
+        На настройках по умолчанию датчики не ответили ни на одном порту: подбираем скорость и формат кадра
+        на всех адаптерах сразу (detect_framings) и открываем первый порт с ответившим датчиком
+        """
+        print("\nПодбираем скорость и формат кадра на портах " +
+              ", ".join(com_port.device for com_port in ports) + "...")
+        framings = detect_framings([com_port.device for com_port in ports], slaves)
+        default = (self.baudrate, self.parity, self.stopbits)
+        for com_port in sorted(ports, key=lambda com_port: not is_usb_serial(com_port)):
+            framing = framings.get(com_port.device)
+            if framing is None:
+                continue
+            self.port = com_port.device
+            self.apply_framing(framing)
+            try:
+                self.open()
+                if self.check_ports():
+                    border_print(["Подключено к " + self.port,
+                                  "Скорость {0}, четность {1}, стоп-битов {2}".format(*framing)], "#")
+                    return True
+            except serial.serialutil.SerialException:
+                pass
+            self.port = None
+        self.apply_framing(default)
+        return False
+
+    def autodetect(self, slaves=(1,)):
+        """
+        Подбираем скорость и формат кадра открытого порта по ответу датчиков slaves
+        """
+        print("\nПодбираем скорость и формат кадра порта " + self.port + "...")
+        framing = sweep_framing(self, slaves, cached_framing(self.port))
+        if framing is None:
+            border_print("Датчики не ответили ни на одной скорости", "!")
+            return None
+        if cache is not None:
+            cache.set_framing(adapter_id(self.port), framing)
+        border_print("Скорость {0}, четность {1}, стоп-битов {2}".format(*framing), "#")
+        return framing
+
+
+class Device(mb_rtu.RtuMaster):
+    """
+    Экземпляр устройства в сети по протоколу ModbusRTU
+    """
+    def __init__(self, port, slave=None, cancel=None):
+        super(Device, self).__init__(serial=port)
+        self.slave = slave
+        self.slaves = []
+        self.is_connect = False
+        self.set_timeout(0.1)
+        self.rtt = link_rtt("{0}@{1}".format(bus_label(self), port.baudrate), 0.1, rtu_timing(port.baudrate)[2], 0.5)
+        self.lock = RLock()
+        self.cancel_token = cancel or abort
+        self.collisions = []
+        self.try_connect()
+
+    def try_connect(self):
+        if self.slave is None:
+            print("\nНажмите [ {0} ] чтобы прервать процесс поиска".format(abort.key))
+            try:
+                # Поиск всегда опрашивает все адреса: по адресам из кэша не найти только что установленный датчик
+                print("\nОпрашиваем адреса датчиков 1-247", end="", flush=True)
+                self.slaves = self.enumerate_slaves()
+            except serial.serialutil.SerialException:
+                self.slaves = []
+            print()
+            self.report_collisions()
+            if self.slaves:
+                border_print(["Ответили датчики по адресам:", ", ".join(str(slave) for slave in self.slaves)], "#")
+                self.slave = self.slaves[0]
+                self.is_connect = True
+                border_print("Подключились к датчику по адресу " + str(self.slave), "#")
+        else:
+            print("\nПытаемся подключиться к датчику по адресу", self.slave, end="")
+            for attempt in range(10):
+                if self.cancel_token.is_set():
+                    break
+                print(" .", end="", flush=True)
+                with self.lock:
+                    self.apply_timeout()
+                    result = self.probe_slave(self.slave)
+                if result in ("crc", "overlap"):
+                    # Битые кадры не повторяем вслепую: выясняем, помехи это или два датчика с одним адресом
+                    result = self.diagnose_slave(self.slave)
+                    if result == "collision":
+                        self.collisions = [self.slave]
+                        print()
+                        self.report_collisions()
+                if result == "ok":
+                    self.is_connect = True
+                    print()
+                    border_print("Подключились к датчику по адресу " + str(self.slave), "#")
+                if result != "silent":
+                    break
+        if not self.is_connect:
+            print()
+            border_print("Подключиться не удалось", "!")
+        else:
+            if cache is not None:
+                cache.add_slaves(self.cache_key(), self.slaves or [self.slave])
+            if inventory is not None:
+                inventory.seen(self.cache_key(), self.slaves or [self.slave])
+
+    def report_collisions(self):
+        if not self.collisions:
+            return
+        border_print(["Похоже, по этим адресам отвечает несколько датчиков:",
+                      ", ".join(str(slave) for slave in self.collisions),
+                      "Отключите лишние датчики и переадресуйте их по одному"], "!")
+        if inventory is not None:
+            inventory.seen(self.cache_key(), self.collisions, health=HEALTH_DUPLICATE)
+
+    def probe_slave(self, slave):
+        """
+        Одиночный запрос регистра 249 без повторов (см. rtu_probe)
+        """
+        return rtu_probe(self, slave)
+
+    def diagnose_slave(self, slave, attempts=6, reference=None):
+        """
+        Повторный опрос адреса, давшего битый кадр, с удвоенным таймаутом.
+        Чтобы отличить помехи на линии от двух датчиков с одним адресом, между попытками опрашивается
+        заведомо исправный адрес reference (если он есть): линия чистая, а ответы slave битые - конфликт адресов.
+        Возвращаем "ok", "collision", "noise", "error" или "silent"
+        """
+        counts = {"ok": 0, "error": 0, "crc": 0, "overlap": 0, "silent": 0}
+        line_clean = True
+        with self.lock:
+            saved_timeout = self.get_timeout()
+            _, inter_frame, response = rtu_timing(self._serial.baudrate)
+            self.set_timeout(2 * response)
+            try:
+                for attempt in range(attempts):
+                    if self.cancel_token.is_set():
+                        break
+                    counts[self.probe_slave(slave)] += 1
+                    time.sleep(inter_frame)
+                    if reference is not None:
+                        line_clean = line_clean and self.probe_slave(reference) == "ok"
+                        time.sleep(inter_frame)
+            finally:
+                self.set_timeout(saved_timeout)
+        corrupted = counts["crc"] + counts["overlap"]
+        if counts["overlap"] or (corrupted and (counts["ok"] or (reference is not None and line_clean))):
+            return "collision"
+        if corrupted:
+            return "noise"
+        for result in ("ok", "error"):
+            if counts[result]:
+                return result
+        return "silent"
+
+    def enumerate_slaves(self, slaves=range(1, 248), retries=3):
+        """
+        Быстрая инвентаризация шины: таймауты считаются от скорости порта,
+        каждый адрес опрашивается один раз, повторно (diagnose_slave) - только адреса с битыми кадрами.
+        Возвращаем отсортированный список ответивших адресов, вероятные конфликты адресов - в self.collisions
+        """
+        self.open()
+        saved_timeout = self.get_timeout()
+        saved_inter_byte = self._serial.inter_byte_timeout
+        inter_char, inter_frame, response = rtu_timing(self._serial.baudrate)
+        self._serial.inter_byte_timeout = inter_char
+        found = []
+        ambiguous = []
+        self.collisions = []
+        try:
+            self.set_timeout(response)
+            for slave in slaves:
+                if self.cancel_token.is_set():
+                    break
+                result = self.probe_slave(slave)
+                if result == "ok":
+                    found.append(slave)
+                elif result in ("crc", "overlap"):
+                    ambiguous.append(slave)
+                time.sleep(inter_frame)
+            print(" .", end="", flush=True)
+            # Два датчика с одинаковыми ответами иногда дают чистый кадр: ответившие адреса опрашиваем еще раз
+            for slave in list(found):
+                if self.cancel_token.is_set():
+                    break
+                if self.probe_slave(slave) in ("crc", "overlap"):
+                    found.remove(slave)
+                    ambiguous.append(slave)
+                time.sleep(inter_frame)
+            # Повторно опрашиваем только адреса с битыми кадрами, сверяясь с исправным адресом
+            reference = found[0] if found else None
+            for slave in ambiguous:
+                if self.cancel_token.is_set():
+                    break
+                verdict = self.diagnose_slave(slave, 2 * retries, reference)
+                if verdict == "ok":
+                    found.append(slave)
+                elif verdict == "collision":
+                    self.collisions.append(slave)
+            self.collisions.sort()
+            if ambiguous:
+                print(" .", end="", flush=True)
+        finally:
+            self.set_timeout(saved_timeout)
+            self._serial.inter_byte_timeout = saved_inter_byte
+        return sorted(found)
+
+    def execute(self, *args, **kwargs):
+        # modbus_tk держит одну блокировку на все устройства, из-за нее шины не работали бы параллельно,
+        # поэтому запросы сериализуются только в пределах своего устройства
+        kwargs.setdefault("threadsafe", False)
+        with self.lock:
+            self.apply_timeout()
+            start = time.perf_counter()
+            try:
+                if metrics is None:
+                    result = super(Device, self).execute(*args, **kwargs)
+                else:
+                    result = metrics.observe(self, super(Device, self).execute, args, kwargs)
+            except Exception as err:
+                if classify_error(err) == "timeout":
+                    self.rtt.backoff()
+                raise
+            self.rtt.sample(time.perf_counter() - start)
+            return result
+
+    def apply_timeout(self):
+        """
+        Таймаут транзакции берем из оценки времени отклика канала
+        """
+        timeout = self.rtt.timeout()
+        if abs(timeout - self.get_timeout()) > 0.1 * self.get_timeout():
+            self.set_timeout(timeout)
+
+    def select_slave(self, slave):
+        """
+        Переключаемся на другой датчик той же шины без переподключения
+        """
+        self.slave = slave
+        self.slaves = []
+        self.is_connect = False
+        self.try_connect()
+
+    def read_config(self, fields=None):
+        """
+        Снимок конфигурации подключенного датчика (см. read_snapshot)
+        """
+        return read_snapshot(self, fields)
+
+    def cache_key(self):
+        return "rtu", adapter_id(self._serial.port)
+
+    def check_connect(self):
+        return self.is_connect
+
+    def write_slave(self, new_address):
+        old_address = self.slave
+
+        if new_address is not None and new_address > 0 and new_address != old_address:
+            print("\nПишем новый адрес " + str(new_address) + " в устройство", end="")
+            for attempt in range(5):
+                if self.cancel_token.is_set():
+                    break
+                print(" .", end="", flush=True)
+                try:
+                    # Эхо ответа на запись подтверждает, что датчик принял новый адрес
+                    reply = self.execute(old_address, mb_def.WRITE_SINGLE_REGISTER, 249, 1, new_address)
+                    if tuple(reply) == (249, new_address):
+                        break
+                except modbus_tk.exceptions.ModbusError:
+                    break
+                except modbus_tk.exceptions.ModbusInvalidResponseError:
+                    # Датчик мог принять запись и уже не отвечать по старому адресу
+                    if self.check_slave(new_address):
+                        break
+                time.sleep(0.02 * 2 ** attempt)
+            print()
+            self.slave = new_address
+            if not self.try_new_slave():
+                self.slave = old_address
+            else:
+                if cache is not None:
+                    cache.move_slave(self.cache_key(), old_address, new_address)
+                if inventory is not None:
+                    inventory.move(self.cache_key(), old_address, new_address)
+        else:
+            border_print("Адрес датчика не изменен", "#")
+
+    def check_slave(self, slave):
+        """
+        Одно чтение регистра 249: отвечает ли датчик по адресу slave
+        """
+        try:
+            return self.execute(slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)[0] == slave
+        except modbus_tk.exceptions.ModbusInvalidResponseError:
+            return False
+
+    def try_new_slave(self):
+        self.is_connect = False
+        for attempt in range(5):
+            if self.check_slave(self.slave):
+                self.is_connect = True
+                border_print("Новый адрес датчика записан", "#")
+                return True
+            time.sleep(0.02 * 2 ** attempt)
+        border_print("Запись не удалась", "!")
+        return False
+
+
+class TcpDevice(mb_tcp.TcpMaster):
+    """
+    Экземпляр устройства в сети по протоколу ModbusTCP
+    """
+    def __init__(self, host, port, slave=None, sock=None, cancel=None, connect=True):
+        super(TcpDevice, self).__init__(host=host, port=port, timeout_in_sec=0.25)
+        if sock is not None and sock.check_connect():
+            # Работаем через уже открытое подключение вместо второго
+            self._sock = sock
+            self._is_opened = True
+            self.set_timeout(self.get_timeout())
+        self.slave = slave
+        self.slaves = []
+        self.is_connect = False
+        # self.set_timeout(0.25)
+        self.rtt = link_rtt(bus_label(self), 0.25, 0.02, 1.0)
+        self.last_transaction = b""
+        self.lock = RLock()
+        self.cancel_token = cancel or abort
+        if connect:
+            self.try_connect()
+
+    def try_connect(self):
+        if self.slave is None:
+            print("\nНажмите [ {0} ] чтобы прервать процесс поиска".format(abort.key))
+            try:
+                # Поиск всегда опрашивает все адреса: по адресам из кэша не найти только что установленный датчик
+                print("\nОпрашиваем адреса датчиков 1-247", end="", flush=True)
+                self.slaves = self.discover_slaves()
+            except (socket.timeout, socket.error):
+                self.slaves = []
+            print()
+            if self.slaves:
+                border_print(["Ответили датчики по адресам:", ", ".join(str(slave) for slave in self.slaves)], "#")
+                self.slave = self.slaves[0]
+                self.is_connect = True
+                border_print("Подключились к датчику по адресу " + str(self.slave), "#")
+        else:
+            print("\nПытаемся подключиться к датчику по адресу", self.slave, end="")
+            err_cnt = 0
+            while err_cnt < 10 and not self.cancel_token.is_set():
+                print(" .", end="", flush=True)
+                try:
+                    get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
+                    if get_data[0] == self.slave:
+                        self.is_connect = True
+                        print()
+                        border_print("Подключились к датчику по адресу " + str(self.slave), "#")
+                        break
+                except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError,
+                        modbus_tk.exceptions.ModbusInvalidResponseError):
+                    self.is_connect = False
+                err_cnt += 1
+        if not self.is_connect:
+            print()
+            border_print("Подключиться не удалось", "!")
+        else:
+            if cache is not None:
+                cache.add_slaves(self.cache_key(), self.slaves or [self.slave])
+            if inventory is not None:
+                inventory.seen(self.cache_key(), self.slaves or [self.slave])
+
+    def discover_slaves(self, slaves=range(1, 248), window=32, retries=2):
+        """
+        Параллельный опрос адресов: в сеть уходит до window запросов регистра 249 сразу,
+        ответы сопоставляются по идентификатору транзакции MBAP,
+        повторно опрашиваются только адреса, не ответившие за таймаут.
+        Возвращаем отсортированный список всех ответивших адресов
+        """
+        self.open()
+        timeout = self.rtt.timeout()
+        found = set()
+        answered = set()
+        sent = {}
+        tid = 0
+        pending = list(slaves)
+        # Буфер общий для всех проходов: опоздавший ответ прошлого прохода не сбивает разбор потока
+        buf = b""
+        for _ in range(retries + 1):
+            if not pending or self.cancel_token.is_set():
+                break
+            queue = deque(pending)
+            in_flight = {}
+            while (queue or in_flight) and not self.cancel_token.is_set():
+                while queue and len(in_flight) < window:
+                    slave = queue.popleft()
+                    tid = (tid + 1) & 0xffff
+                    sent[tid] = slave
+                    in_flight[tid] = time.monotonic() + timeout
+                    request = mbap_request(tid, slave)
+                    if capture is not None:
+                        capture.record(capture_label(self), CAPTURE_TX, request)
+                    self._sock.send(request)
+                now = time.monotonic()
+                for expired in [t for t, deadline in in_flight.items() if deadline <= now]:
+                    del in_flight[expired]
+                    if metrics is not None:
+                        metrics.record(bus_label(self), sent[expired], mb_def.READ_HOLDING_REGISTERS, timeout,
+                                       "timeout")
+                if not in_flight:
+                    continue
+                if not select.select([self._sock], [], [], max(0.0, min(in_flight.values()) - now))[0]:
+                    continue
+                data = self._sock.recv(4096)
+                if not data:
+                    # Шлюз закрыл соединение - переподключаемся, неответившие адреса уйдут на повтор
+                    self._do_open()
+                    buf = b""
+                    break
+                buf += data
+                desync = False
+                while len(buf) >= 7:
+                    protocol, length = struct.unpack(">HH", buf[2:6])
+                    if protocol != 0 or not 2 <= length <= 254:
+                        desync = True
+                        break
+                    if len(buf) < length + 6:
+                        break
+                    frame, buf = buf[:length + 6], buf[length + 6:]
+                    if capture is not None:
+                        capture.record(capture_label(self), CAPTURE_RX, frame)
+                    r_tid, _, _, unit = struct.unpack(">HHHB", frame[:7])
+                    pdu = frame[7:]
+                    slave = sent.get(r_tid)
+                    deadline = in_flight.pop(r_tid, None)
+                    if slave is None or slave != unit or not pdu:
+                        if metrics is not None and slave is not None:
+                            metrics.record(bus_label(self), slave, mb_def.READ_HOLDING_REGISTERS, 0.0, "mbap")
+                        continue
+                    if deadline is not None:
+                        self.rtt.sample(time.monotonic() - deadline + timeout)
+                    if metrics is not None and deadline is not None:
+                        metrics.record(bus_label(self), slave, mb_def.READ_HOLDING_REGISTERS,
+                                       time.monotonic() - deadline + timeout, "exception" if pdu[0] & 0x80 else "ok")
+                    reply = probe_reply(pdu, slave)
+                    if reply == "ok":
+                        found.add(slave)
+                    elif reply == "error":
+                        # Ответило другое устройство - адрес занят не датчиком, повторять незачем
+                        answered.add(slave)
+                if desync:
+                    # Заголовок MBAP испорчен - границу следующего кадра не найти: переподключаемся,
+                    # неответившие адреса уйдут на повтор
+                    if capture is not None:
+                        capture.record(capture_label(self), CAPTURE_RX, buf)
+                    self._do_open()
+                    buf = b""
+                    break
+            pending = [slave for slave in pending if slave not in found and slave not in answered]
+            print(" .", end="", flush=True)
+        return sorted(found)
+
+    def execute(self, *args, **kwargs):
+        # см. Device.execute
+        kwargs.setdefault("threadsafe", False)
+        with self.lock:
+            self.apply_timeout()
+            start = time.perf_counter()
+            try:
+                if metrics is None:
+                    result = super(TcpDevice, self).execute(*args, **kwargs)
+                else:
+                    result = metrics.observe(self, super(TcpDevice, self).execute, args, kwargs)
+            except Exception as err:
+                if classify_error(err) == "timeout":
+                    self.rtt.backoff()
+                raise
+            self.rtt.sample(time.perf_counter() - start)
+            return result
+
+    def apply_timeout(self):
+        """
+        Таймаут транзакции берем из оценки времени отклика канала
+        """
+        timeout = self.rtt.timeout()
+        if abs(timeout - self.get_timeout()) > 0.1 * self.get_timeout():
+            self.set_timeout(timeout)
+
+    def _do_open(self):
+        # Переподключение ждет не меньше оценки времени установления соединения, а не таймаут транзакции
+        timeout = self.get_timeout()
+        self.set_timeout(max(timeout, connect_rtt(self._host).timeout()))
+        try:
+            super(TcpDevice, self)._do_open()
+        finally:
+            self.set_timeout(timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send(self, request):
+        self.last_transaction = request[:2]
+        super(TcpDevice, self)._send(request)
+
+    def _recv(self, expected_length=-1):
+        # Опоздавший ответ на прошлый запрос (чужой номер транзакции) отбрасываем и ждем свой
+        while True:
+            response = super(TcpDevice, self)._recv(expected_length)
+            if len(response) < 2 or response[:2] == self.last_transaction:
+                return response
+
+    def select_slave(self, slave):
+        """
+        Переключаемся на другой датчик той же шины без переподключения
+        """
+        self.slave = slave
+        self.slaves = []
+        self.is_connect = False
+        self.try_connect()
+
+    def read_config(self, fields=None):
+        """
+        Снимок конфигурации подключенного датчика (см. read_snapshot)
+        """
+        return read_snapshot(self, fields)
+
+    def cache_key(self):
+        return "tcp", self._host, self._port
+
+    def check_connect(self):
+        return self.is_connect
+
+    def write_slave(self, new_address):
+        old_address = self.slave
+
+        if new_address is not None and new_address > 0 and new_address != old_address:
+            print("\nПишем новый адрес " + str(new_address) + " в устройство", end="")
+            for attempt in range(5):
+                if self.cancel_token.is_set():
+                    break
+                print(" .", end="", flush=True)
+                try:
+                    # Эхо ответа на запись подтверждает, что датчик принял новый адрес
+                    reply = self.execute(old_address, mb_def.WRITE_SINGLE_REGISTER, 249, 1, new_address)
+                    if tuple(reply) == (249, new_address):
+                        break
+                except modbus_tk.exceptions.ModbusError:
+                    break
+                except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError,
+                        modbus_tk.exceptions.ModbusInvalidResponseError):
+                    # Датчик мог принять запись и уже не отвечать по старому адресу
+                    if self.check_slave(new_address):
+                        break
+                time.sleep(0.02 * 2 ** attempt)
+            print()
+            self.slave = new_address
+            if not self.try_new_slave():
+                self.slave = old_address
+            else:
+                if cache is not None:
+                    cache.move_slave(self.cache_key(), old_address, new_address)
+                if inventory is not None:
+                    inventory.move(self.cache_key(), old_address, new_address)
+        else:
+            border_print("Адрес датчика не изменен", "#")
+
+    def check_slave(self, slave):
+        """
+        Одно чтение регистра 249: отвечает ли датчик по адресу slave
+        """
+        try:
+            return self.execute(slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)[0] == slave
+        except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError,
+                modbus_tk.exceptions.ModbusInvalidResponseError):
+            return False
+
+    def try_new_slave(self):
+        self.is_connect = False
+        for attempt in range(5):
+            if self.check_slave(self.slave):
+                self.is_connect = True
+                border_print("Новый адрес датчика записан", "#")
+                return True
+            time.sleep(0.02 * 2 ** attempt)
+        border_print("Запись не удалась", "!")
+        return False
+
+
+def get_int(message="", name="", minimum=0, maximum=65535, zero_exit=False):
+    """
+    Функция проверяет введенные пользователем данные на int и принадлежность к диапазону
+    """
+    while True:
+        try:
+            line = input(message)
+            if not line:
+                return None
+            usr_int = int(line)
+            if zero_exit and usr_int == 0:
+                return "quit"
+            elif not zero_exit and usr_int == 0:
+                return None
+            if maximum < usr_int or usr_int < minimum:
+                raise _RangeError("{0} не в диапазоне от {1} до {2}.".format(name, minimum, maximum))
+            return usr_int
+        except _RangeError as err:
+            border_print("ERROR:" + str(err), "!")
+        except ValueError:
+            border_print("ERROR: {0} не число".format(name), "!")
+
+
+def programm_exit():
+    """
+    Закрываем порты перед окончанием программы
+    """
+    global port_obj
+    if pool is not None:
+        pool.close_all()
+    disable_capture()
+    if inventory is not None:
+        inventory.save()
+    if port_obj is not None:
+        port_obj.close()
+        if not port_obj.check_ports():
+            border_print(["Программа завершена", " нажмите [ Ввод ]"], "*")
+    else:
+        border_print(["Программа завершена", " нажмите [ Ввод ]"], "*")
+    input()
+
+
+def border_print(message, hor_sym, vert_sym=None):
+    """
+    Делаем рамку вокруг сообщения
+    """
+    print()
+    if vert_sym is None:
+        vert_sym = hor_sym
+    if type(message) == list:
+        max_len = 0
+        for mess in message:
+            if len(mess) > max_len:
+                max_len = len(mess)
+        print(hor_sym * (max_len + 4))
+        for num, mess in enumerate(message):
+            if num == 0:
+                print(vert_sym + " " * (((max_len + 2) - len(mess)) // 2) + mess +
+                      " " * (((max_len + 2) - len(mess)) - ((max_len + 2) - len(mess)) // 2) + vert_sym)
+            else:
+                print(vert_sym + " " + mess + " " * (max_len - len(mess) + 1) + vert_sym)
+        print(hor_sym * (max_len + 4))
+    else:
+        print(hor_sym * (len(message) + 4))
+        print(vert_sym + " " + message + " " + vert_sym)
+        print(hor_sym * (len(message) + 4))
+
+
+def get_bool(message="\nСконфигурировать новый датчик? (да/д/yes/y): ", lst=None):
+    """
+    Возвращаем подтверждение от пользователя
+    """
+    if lst is None:
+        lst = ["да", "д", "y", "yes"]
+    yes = frozenset(lst)
+    line = input(message)
+    return line.lower() in yes
+
+
+def get_host():
+    """
+    Проверяем корректность введенного адреса или подсети
+    """
+    correct_host = re.compile("([0-9]{1,3}[.]){3}[0-9]{1,3}")
+    while True:
+        host = input("\nВведите IP адрес или подсеть для поиска шлюзов (например 192.168.1.0/24):"
+                     "\n\t(пустое поле или 0 - выход из программы): ")
+        if not host or host == "0":
+            return "quit"
+        if "/" in host:
+            try:
+                ipaddress.ip_network(host, strict=False)
+                return host
+            except ValueError:
+                border_print("Ввод некорректен", "!")
+        elif re.match(correct_host, host):
+            return host
+        else:
+            border_print("Ввод некорректен", "!")
+
+
+def find_gateway(network):
+    """
+    Ищем шлюзы Modbus TCP в подсети и возвращаем (host, port) выбранного пользователем
+    """
+    while True:
+        line = input("\nВведите номера портов через запятую"
+                     "\n\t(пустое поле - 502): ")
+        try:
+            ports = [int(port) for port in line.replace(" ", "").split(",") if port] or [502]
+            for port in ports:
+                if not 1 <= port <= 65535:
+                    raise _RangeError("номер порта {0} не в диапазоне от 1 до 65535.".format(port))
+            break
+        except _RangeError as err:
+            border_print("ERROR: " + str(err), "!")
+        except ValueError:
+            border_print("ERROR: номер порта не число", "!")
+    targets = gateway_targets([network], ports)
+    if targets > GATEWAY_SCAN_LIMIT and \
+            not get_bool("\nБудет проверено {0} адресов, это может занять много времени. Продолжить? (да/д/yes/y): "
+                         .format(targets)):
+        return None
+    print("\nНажмите [ {0} ] чтобы прервать процесс поиска".format(abort.key))
+    print("\nИщем шлюзы Modbus TCP в подсети " + network)
+    with abort.running():
+        gateways = discover_gateways([network], ports, stop=abort.is_set,
+                                     on_found=lambda gateway: print("Найден шлюз {0}:{1}".format(*gateway),
+                                                                    flush=True))
+    if not gateways:
+        border_print("Шлюзы Modbus TCP в подсети не найдены", "!")
+        return None
+    for host, port, _ in gateways:
+        cache.add_ports(host, [port])
+    if len(gateways) == 1:
+        return gateways[0][:2]
+    border_print(["НАЙДЕННЫЕ ШЛЮЗЫ:"] + ["{0} - {1}:{2}{3}".format(num, host, port, " (датчик по адресу 1)"
+                                                                  if status == "sensor" else "")
+                                        for num, (host, port, status) in enumerate(gateways, 1)], "~", "|")
+    num = get_int("\nВведите номер шлюза и нажмите [ Ввод ]"
+                  "\n\t(пустое поле или 0 - выход из программы): ",
+                  name="номер шлюза", minimum=1, maximum=len(gateways), zero_exit=True)
+    if num is None or num == "quit":
+        return None
+    return gateways[num - 1][:2]
+
+
+def watch_abort(esc=True):
+    """
+    Прерывание операций по Esc (если клавиатура доступна и esc=True) и по Ctrl+C.
+    Вне операции Ctrl+C, как и раньше, завершает программу.
+    Пакетный режим, подкоманды и служба вызывают с esc=False: без меню клавиатуру не перехватываем
+    """
+    def on_sigint(signum, frame):
+        if not abort.interrupt("Ctrl+C"):
+            raise KeyboardInterrupt
+
+    try:
+        signal.signal(signal.SIGINT, on_sigint)
+    except ValueError:
+        # Вызов не из главного потока - обработчик сигнала поставить нельзя
+        pass
+    if esc:
+        try:
+            import keyboard
+            keyboard.add_hotkey("esc", abort.interrupt, args=("Esc",))
+            abort.key = "Esc"
+        except Exception:
+            # Без модуля keyboard, прав root или графической сессии перехват клавиатуры недоступен, остается Ctrl+C
+            pass
+
+
+# Приоритеты транзакций шлюза: плановый опрос, затем конфигурирование, затем массовый поиск
+PRIORITY_POLL = 0
+PRIORITY_CONFIG = 1
+PRIORITY_SCAN = 2
+READ_FUNCTIONS = (mb_def.READ_HOLDING_REGISTERS, mb_def.READ_INPUT_REGISTERS)
+
+
+class Transaction(object):
+    """
+    Транзакция в очереди шлюза. Одинаковые чтения, ждущие в очереди, выполняются один раз
+    и отдают результат всем ожидающим (waiters)
+    """
+    def __init__(self, slave, args, kwargs, priority):
+        self.slave = slave
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.waiters = 1
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+    def key(self):
+        """
+        Ключ объединения: (адрес, функция, регистр, количество) для чтений, None для записи
+        """
+        if self.kwargs or len(self.args) < 3 or self.args[0] not in READ_FUNCTIONS:
+            return None
+        return self.slave, self.args[0], self.args[1], self.args[2]
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class GatewayScheduler(object):
+    """
+    Очередь транзакций одного шлюза для многих логических устройств (адресов за шлюзом).
+    Одновременно выполняется столько транзакций, сколько подключений в masters (для шлюза RS-485 - одно).
+    Меньший приоритет выполняется раньше, внутри приоритета адреса обслуживаются по очереди
+    (справедливая очередь по виртуальному времени), повторные чтения объединяются.
+    Чтение, не дождавшееся ответа, повторяется до retries раз (кроме поиска)
+    """
+    def __init__(self, masters, retries=1):
+        self.masters = list(masters)
+        self.retries = retries
+        self.heap = []
+        self.pending = {}
+        self.finish = {}
+        self.vtime = {}
+        self.seq = 0
+        self.executed = 0
+        self.merged = 0
+        self.closed = False
+        self.cond = Condition()
+        self.workers = [Thread(target=self.worker, args=(master,), daemon=True) for master in self.masters]
+        for worker in self.workers:
+            worker.start()
+
+    def push(self, transaction, priority):
+        # Виртуальное время адреса растет на единицу с каждой его транзакцией
+        tag = max(self.vtime.get(priority, 0), self.finish.get((priority, transaction.slave), 0)) + 1
+        self.finish[(priority, transaction.slave)] = tag
+        self.seq += 1
+        heapq.heappush(self.heap, (priority, tag, self.seq, transaction))
+
+    def submit(self, slave, args, kwargs=None, priority=PRIORITY_CONFIG):
+        transaction = Transaction(slave, tuple(args), dict(kwargs or {}), priority)
+        key = transaction.key()
+        with self.cond:
+            if self.closed:
+                raise socket.error("Очередь шлюза закрыта")
+            queued = self.pending.get(key) if key is not None else None
+            if queued is not None:
+                queued.waiters += 1
+                self.merged += 1
+                if priority < queued.priority:
+                    queued.priority = priority
+                    self.push(queued, priority)
+                return queued
+            if key is not None:
+                self.pending[key] = transaction
+            self.push(transaction, priority)
+            self.cond.notify()
+        return transaction
+
+    def execute(self, slave, *args, **kwargs):
+        priority = kwargs.pop("priority", PRIORITY_CONFIG)
+        return self.submit(slave, args, kwargs, priority).wait()
+
+    def next_transaction(self):
+        with self.cond:
+            while True:
+                while not self.heap and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return None
+                priority, tag, _, transaction = heapq.heappop(self.heap)
+                if transaction.started_at is not None or transaction.priority != priority:
+                    # Устаревшая запись: транзакция уже выполнена или поднята в приоритете
+                    continue
+                self.vtime[priority] = tag
+                transaction.started_at = time.monotonic()
+                key = transaction.key()
+                if key is not None:
+                    self.pending.pop(key, None)
+                return transaction
+
+    def worker(self, master):
+        while True:
+            transaction = self.next_transaction()
+            if transaction is None:
+                return
+            for attempt in range(self.retries + 1):
+                try:
+                    transaction.result = master.execute(transaction.slave, *transaction.args, **transaction.kwargs)
+                    transaction.error = None
+                    break
+                except Exception as err:
+                    transaction.error = err
+                    # Чтение можно безопасно повторить, запись - нет; при поиске молчание адреса - обычный ответ
+                    if classify_error(err) != "timeout" or transaction.key() is None or \
+                            transaction.priority >= PRIORITY_SCAN:
+                        break
+            self.executed += 1
+            transaction.done.set()
+
+    def device(self, slave, priority=PRIORITY_CONFIG):
+        return ScheduledDevice(self, slave, priority)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for _, _, _, transaction in self.heap:
+                if transaction.started_at is None:
+                    transaction.error = socket.error("Очередь шлюза закрыта")
+                    transaction.done.set()
+            self.heap = []
+            self.pending.clear()
+            self.cond.notify_all()
+        for master in self.masters[1:]:
+            master.close()
+
+
+class ScheduledDevice(object):
+    """
+    Устройство для read_snapshot/read_field/push_config, транзакции которого идут через очередь шлюза
+    с заданным приоритетом. В queued копится время ожидания в очереди
+    """
+    def __init__(self, scheduler, slave, priority):
+        self.scheduler = scheduler
+        self.slave = slave
+        self.priority = priority
+        self.queued = 0.0
+
+    def cache_key(self):
+        return self.scheduler.masters[0].cache_key()
+
+    def execute(self, slave, *args, **kwargs):
+        transaction = self.scheduler.submit(slave, args, kwargs, self.priority)
+        try:
+            return transaction.wait()
+        finally:
+            if transaction.started_at is not None:
+                self.queued += max(0.0, transaction.started_at - transaction.queued_at)
+
+
+def scan_slaves(scheduler, slaves=range(1, 248)):
+    """
+    Поиск датчиков через очередь шлюза с низшим приоритетом: опрос и конфигурирование идут без задержек.
+    Возвращаем отсортированный список ответивших адресов
+    """
+    transactions = [(slave, scheduler.submit(slave, (mb_def.READ_HOLDING_REGISTERS, 249, 1), priority=PRIORITY_SCAN))
+                    for slave in slaves]
+    found = []
+    for slave, transaction in transactions:
+        try:
+            if transaction.wait()[0] == slave:
+                found.append(slave)
+        except (socket.error, modbus_tk.exceptions.ModbusError, modbus_tk.exceptions.ModbusInvalidResponseError,
+                modbus_tk.modbus_tcp.ModbusInvalidMbapError):
+            pass
+    return found
+
+
+def socket_alive(sock):
+    """
+    Проверяем, что TCP соединение не закрыто удаленной стороной
+    """
+    try:
+        if select.select([sock], [], [], 0)[0]:
+            return sock.recv(1, socket.MSG_PEEK) != b""
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+class Session(object):
+    """
+    Подключение к одной шине: транспорт (Sock или Port) и устройство Modbus поверх него
+    """
+    def __init__(self, key, transport):
+        self.key = key
+        self.transport = transport
+        self.device = None
+        self.gateway = None
+        self.last_used = time.monotonic()
+        # Устройство и очередь шлюза создаются один раз, даже если их одновременно запросили несколько клиентов
+        self.lock = RLock()
+
+    def scheduler(self, in_flight=1):
+        """
+        Очередь транзакций шлюза (только Modbus TCP); in_flight - число одновременных транзакций,
+        каждая сверх первой идет через отдельное подключение
+        """
+        with self.lock:
+            if self.gateway is None:
+                if self.device is None:
+                    self.device = TcpDevice(self.key[1], self.key[2], sock=self.transport, connect=False)
+                masters = [self.device] + [TcpDevice(self.key[1], self.key[2], connect=False)
+                                           for _ in range(in_flight - 1)]
+                self.gateway = GatewayScheduler(masters)
+            return self.gateway
+
+    def device_for(self, slave):
+        """
+        Возвращаем TcpDevice/Device этой шины, подключенный к датчику slave
+        """
+        with self.lock:
+            if self.device is None:
+                if self.key[0] == "tcp":
+                    self.device = TcpDevice(self.key[1], self.key[2], slave, sock=self.transport)
+                else:
+                    self.device = Device(self.transport, slave)
+                return self.device
+        self.device.select_slave(slave)
+        return self.device
+
+    def check(self):
+        """
+        Проверяем подключение и при обрыве переподключаемся
+        """
+        if self.key[0] == "rtu":
+            try:
+                if not self.transport.is_open:
+                    self.transport.open()
+                return True
+            except serial.serialutil.SerialException:
+                return False
+        if self.device is not None:
+            if self.device._sock is not None and socket_alive(self.device._sock):
+                return True
+            try:
+                self.device.close()
+                self.device.open()
+                return True
+            except socket.error:
+                return False
+        if socket_alive(self.transport):
+            return True
+        self.transport.close()
+        self.transport = Sock(self.key[1], self.key[2])
+        return self.transport.check_connect()
+
+    def close(self):
+        if self.gateway is not None:
+            self.gateway.close()
+        if self.device is not None:
+            self.device.close()
+        self.transport.close()
+
+
+class SessionPool(object):
+    """
+    Пул открытых подключений: ключ ("tcp", host, port) или ("rtu", имя COM порта).
+    Перед выдачей подключение проверяется, простаивающие дольше ttl
+    и давно не использованные сверх max_size закрываются
+    """
+    def __init__(self, max_size=8, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = RLock()
+        # Блокировка на ключ: одновременные запросы одной шины получают одну сессию, а не по подключению на каждый
+        self.key_locks = {}
+
+    def tcp(self, host, port):
+        """
+        Возвращаем сессию шлюза host:port или None, если подключиться не удалось
+        """
+        return self.acquire(("tcp", host, port), lambda: Sock(host, port), lambda sock: sock.check_connect())
+
+    def rtu(self, port=None):
+        """
+        Возвращаем сессию COM порта (None - автоматический поиск) или None, если порт не открылся
+        """
+        key = None
+        if port is not None:
+            key = ("rtu", port if isinstance(port, str) else "COM{}".format(port))
+        return self.acquire(key, lambda: Port(port), lambda port_obj: port_obj.check_ports())
+
+    def acquire(self, key, factory, connected):
+        with self.lock:
+            self.evict()
+            key_lock = self.key_locks.setdefault(key, Lock()) if key is not None else nullcontext()
+        with key_lock:
+            with self.lock:
+                session = self.sessions.get(key) if key is not None else None
+            if session is not None:
+                if session.check():
+                    session.last_used = time.monotonic()
+                    with self.lock:
+                        self.sessions.move_to_end(key)
+                    return session
+                with self.lock:
+                    if self.sessions.get(key) is session:
+                        del self.sessions[key]
+                session.close()
+            transport = factory()
+            if not connected(transport):
+                transport.close()
+                return None
+            if key is None:
+                key = ("rtu", transport.port)
+            with self.lock:
+                if key in self.sessions:
+                    # Автоматический поиск нашел порт, который уже открыт в пуле
+                    transport.close()
+                    session = self.sessions[key]
+                    session.last_used = time.monotonic()
+                    return session
+                session = self.sessions[key] = Session(key, transport)
+                self.evict()
+            return session
+
+    def evict(self):
+        """
+        Закрываем простаивающие дольше ttl и лишние сверх max_size подключения
+        """
+        with self.lock:
+            now = time.monotonic()
+            for key in [key for key, session in self.sessions.items() if now - session.last_used > self.ttl]:
+                self.sessions.pop(key).close()
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)[1].close()
+
+    def close_all(self):
+        with self.lock:
+            while self.sessions:
+                self.sessions.popitem()[1].close()
+
+
+def load_register_map(path):
+    """
+    Читаем карту регистров из JSON списка [имя, таблица, адрес, формат]
+    и дополняем ей REGISTER_MAP (поля с тем же именем заменяются)
+    """
+    with open(path, encoding="utf-8") as file:
+        fields = [(str(name), str(table), int(address), str(fmt)) for name, table, address, fmt in json.load(file)]
+    for name, table, address, fmt in fields:
+        if table not in ("holding", "input"):
+            raise ValueError("Поле {0}: неизвестная таблица {1}".format(name, table))
+        if fmt not in ("H", "h", "I", "i", "f"):
+            raise ValueError("Поле {0}: неизвестный формат {1}".format(name, fmt))
+    names = set(field[0] for field in fields)
+    REGISTER_MAP[:] = [field for field in REGISTER_MAP if field[0] not in names] + fields
+    return REGISTER_MAP
+
+
+def field_size(fmt):
+    return struct.calcsize(">" + fmt) // 2
+
+
+def plan_blocks(fields, max_gap=4, max_count=125):
+    """
+    Объединяем поля в минимум непрерывных блоков чтения одной таблицы.
+    Разрыв до max_gap регистров читается вместе с полями, блок не длиннее max_count (предел PDU)
+    """
+    blocks = []
+    for table, address, count in sorted((table, address, field_size(fmt)) for _, table, address, fmt in fields):
+        if blocks:
+            last_table, last_address, last_count = blocks[-1]
+            end = max(last_address + last_count, address + count)
+            if last_table == table and address - (last_address + last_count) <= max_gap and \
+                    end - last_address <= max_count:
+                blocks[-1] = (table, last_address, end - last_address)
+                continue
+        blocks.append((table, address, count))
+    return blocks
+
+
+class SensorConfig(object):
+    """
+    Снимок конфигурации датчика: сырые регистры и расшифрованные по карте значения
+    """
+    magic = b"415S"
+
+    def __init__(self, slave, registers, fields=None, timestamp=None):
+        self.slave = slave
+        self.registers = registers
+        self.fields = list(REGISTER_MAP if fields is None else fields)
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.values = OrderedDict()
+        for name, table, address, fmt in self.fields:
+            words = [registers.get((table, address + num)) for num in range(field_size(fmt))]
+            if None not in words:
+                self.values[name] = struct.unpack(">" + fmt, struct.pack(">" + "H" * len(words), *words))[0]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["values"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def fingerprint(self):
+        """
+        64-битный хэш сырых регистров: одинаковая конфигурация - одинаковый хэш
+        """
+        import hashlib
+        digest = hashlib.blake2b(digest_size=8)
+        for (table, address), value in sorted(self.registers.items()):
+            digest.update(struct.pack(">BHH", table == "input", address, value))
+        return struct.unpack(">Q", digest.digest())[0]
+
+    def to_dict(self):
+        return {"slave": self.slave, "timestamp": self.timestamp, "values": self.values,
+                "registers": [[table, address, value] for (table, address), value in sorted(self.registers.items())]}
+
+    def save(self, path):
+        """
+        Сохраняем снимок: .json - текстом, иначе компактно в двоичном виде
+        """
+        if path.lower().endswith(".json"):
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.to_dict(), file, ensure_ascii=False, indent=2)
+            return
+        # Заголовок: сигнатура, адрес, время, число блоков; блок: таблица, адрес, длина, регистры
+        blocks = plan_blocks([("", table, address, "H") for table, address in self.registers], max_gap=0)
+        data = self.magic + struct.pack("<BdH", self.slave, self.timestamp, len(blocks))
+        for table, address, count in blocks:
+            data += struct.pack("<BHH", table == "input", address, count)
+            data += struct.pack("<" + "H" * count, *[self.registers[(table, address + num)] for num in range(count)])
+        with open(path, "wb") as file:
+            file.write(data)
+
+    @classmethod
+    def load(cls, path):
+        if path.lower().endswith(".json"):
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+            registers = dict(((table, address), value) for table, address, value in data["registers"])
+            return cls(data["slave"], registers, timestamp=data["timestamp"])
+        with open(path, "rb") as file:
+            data = file.read()
+        if data[:4] != cls.magic:
+            raise ValueError("{0} не является снимком конфигурации".format(path))
+        slave, timestamp, count = struct.unpack_from("<BdH", data, 4)
+        offset = 4 + struct.calcsize("<BdH")
+        registers = {}
+        for _ in range(count):
+            is_input, address, size = struct.unpack_from("<BHH", data, offset)
+            offset += 5
+            for num, value in enumerate(struct.unpack_from("<" + "H" * size, data, offset)):
+                registers[("input" if is_input else "holding", address + num)] = value
+            offset += 2 * size
+        return cls(slave, registers, timestamp=timestamp)
+
+
+def read_snapshot(device, fields=None, max_gap=4):
+    """
+    Читаем конфигурацию датчика укрупненными блоками (несколько запросов вместо запроса на регистр).
+    Если устройство отвергло блок с разрывом, поля этого блока дочитываются по отдельности
+    """
+    fields = REGISTER_MAP if fields is None else fields
+    functions = {"holding": mb_def.READ_HOLDING_REGISTERS, "input": mb_def.READ_INPUT_REGISTERS}
+    registers = {}
+    for table, address, count in plan_blocks(fields, max_gap):
+        try:
+            blocks = [(address, device.execute(device.slave, functions[table], address, count))]
+        except modbus_tk.exceptions.ModbusError:
+            blocks = []
+            for _, field_table, field_address, fmt in fields:
+                if field_table == table and address <= field_address < address + count:
+                    blocks.append((field_address, device.execute(device.slave, functions[table], field_address,
+                                                                 field_size(fmt))))
+        for start, values in blocks:
+            for num, value in enumerate(values):
+                registers[(table, start + num)] = value
+    config = SensorConfig(device.slave, registers, fields)
+    if inventory is not None and hasattr(device, "cache_key"):
+        inventory.seen(device.cache_key(), [device.slave], config_hash=config.fingerprint())
+    return config
+
+
+def find_field(name, fields=None):
+    for field in REGISTER_MAP if fields is None else fields:
+        if field[0] == name:
+            return field
+    raise KeyError("В карте регистров нет поля " + name)
+
+
+def read_field(device, slave, field):
+    """
+    Читаем одно поле карты регистров у датчика slave через устройство шины
+    """
+    _, table, address, fmt = field
+    function = mb_def.READ_INPUT_REGISTERS if table == "input" else mb_def.READ_HOLDING_REGISTERS
+    words = device.execute(slave, function, address, field_size(fmt))
+    return struct.unpack(">" + fmt, struct.pack(">" + "H" * len(words), *words))[0]
+
+
+class RingBuffer(object):
+    """
+    Кольцевой буфер отсчетов на заранее выделенных массивах: время, адрес датчика, значение.
+    При переполнении старые отсчеты затираются и учитываются в dropped
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.times = array("d", bytes(8 * size))
+        self.slaves = array("B", bytes(size))
+        self.values = array("d", bytes(8 * size))
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self.lock = Lock()
+
+    def append(self, timestamp, slave, value):
+        with self.lock:
+            pos = self.head % self.size
+            self.times[pos] = timestamp
+            self.slaves[pos] = slave
+            self.values[pos] = value
+            self.head += 1
+            if self.head - self.tail > self.size:
+                self.tail += 1
+                self.dropped += 1
+
+    def drain(self):
+        """
+        Забираем накопленные отсчеты одним куском: (времена, адреса, значения)
+        """
+        with self.lock:
+            start, end = self.tail % self.size, self.head % self.size
+            count = self.head - self.tail
+            self.tail = self.head
+            if count == 0:
+                return array("d"), array("B"), array("d")
+            if start < end:
+                parts = [slice(start, end)]
+            else:
+                parts = [slice(start, self.size), slice(0, end)]
+            return tuple(sum((column[part] for part in parts[1:]), column[parts[0]])
+                         for column in (self.times, self.slaves, self.values))
+
+
+class SampleWriter(object):
+    """
+    Пишем отсчеты пачками: .csv - текстом, иначе двоичными записями <d H B d (время, шина, адрес, значение)
+    """
+    record = struct.Struct("<dHBd")
+
+    def __init__(self, path):
+        self.binary = not path.lower().endswith(".csv")
+        self.file = open(path, "wb" if self.binary else "w", **({} if self.binary else {"newline": ""}))
+        if not self.binary:
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(["time", "bus", "slave", "value"])
+
+    def write(self, bus, times, slaves, values):
+        if self.binary:
+            self.file.write(b"".join(self.record.pack(times[num], bus, slaves[num], values[num])
+                                     for num in range(len(times))))
+        else:
+            self.writer.writerows(zip(("{0:.6f}".format(t) for t in times), [bus] * len(times), slaves, values))
+
+    def close(self):
+        self.file.close()
+
+
+class BusPoller(Thread):
+    """
+    Опрос датчиков одной шины по своему расписанию: цикл по всем адресам раз в interval секунд
+    """
+    def __init__(self, session, slaves, field, interval, stop, buffer_size=65536):
+        super(BusPoller, self).__init__(daemon=True)
+        self.session = session
+        self.slaves = list(slaves)
+        self.field = field
+        self.interval = interval
+        self.stop = stop
+        self.buffer = RingBuffer(buffer_size)
+        self.samples = 0
+        self.errors = 0
+        self.missed = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        if self.session.key[0] == "tcp":
+            device = self.session.scheduler().device(self.slaves[0], PRIORITY_POLL)
+        else:
+            device = self.session.device or self.session.device_for(self.slaves[0])
+        start = time.monotonic()
+        deadline = start
+        while not self.stop.is_set():
+            for slave in self.slaves:
+                try:
+                    value = read_field(device, slave, self.field)
+                except (socket.error, serial.serialutil.SerialException, modbus_tk.exceptions.ModbusError,
+                        modbus_tk.exceptions.ModbusInvalidResponseError, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
+                    self.errors += 1
+                    continue
+                self.buffer.append(time.time(), slave, value)
+                self.samples += 1
+            deadline += self.interval
+            now = time.monotonic()
+            if now > deadline:
+                # Цикл опроса не уложился в расписание - пропущенные сроки не догоняем
+                late = int((now - deadline) // self.interval) + 1
+                self.missed += late
+                deadline += late * self.interval
+            self.stop.wait(deadline - now if deadline > now else 0)
+        self.elapsed = time.monotonic() - start
+
+    def rate(self):
+        return self.samples / self.elapsed if self.elapsed else 0.0
+
+
+def poll_sensors(targets, field_name="pressure", interval=0.1, duration=None, path=None, cancel=None,
+                 flush_interval=1.0):
+    """
+    Непрерывный опрос: targets - список (сессия шины, адреса датчиков), каждая шина в своем потоке.
+    Отсчеты сбрасываются в файл path пачками раз в flush_interval, опрос идет до duration или прерывания cancel.
+    Возвращаем статистику по шинам: отсчеты, ошибки, пропущенные сроки, достигнутая частота
+    """
+    field = find_field(field_name)
+    cancel = cancel or abort
+    stop = Event()
+    pollers = [BusPoller(session, slaves, field, interval, stop) for session, slaves in targets]
+    writer = SampleWriter(path) if path else None
+    for poller in pollers:
+        poller.start()
+    end = None if duration is None else time.monotonic() + duration
+    try:
+        while not cancel.is_set() and (end is None or time.monotonic() < end):
+            cancel.wait(flush_interval if end is None else max(0.0, min(flush_interval, end - time.monotonic())))
+            if writer is not None:
+                for bus, poller in enumerate(pollers):
+                    writer.write(bus, *poller.buffer.drain())
+    finally:
+        stop.set()
+        for poller in pollers:
+            poller.join()
+        if writer is not None:
+            for bus, poller in enumerate(pollers):
+                writer.write(bus, *poller.buffer.drain())
+            writer.close()
+    return [{"bus": "/".join(str(part) for part in poller.session.key), "samples": poller.samples,
+             "errors": poller.errors, "missed": poller.missed, "dropped": poller.buffer.dropped,
+             "rate": poller.rate()}
+            for poller in pollers]
+
+
+adapter_ids = {}
+adapter_lock = Lock()
+
+
+def remember_adapters(ports):
+    """
+    Обновляем идентификаторы адаптеров по свежему списку портов (list_ports.comports()) и возвращаем его
+    """
+    with adapter_lock:
+        adapter_ids.clear()
+        for com_port in ports:
+            adapter_ids[com_port.device] = com_port.serial_number or com_port.device
+    return ports
+
+
+def adapter_id(port_name):
+    """
+    Идентификатор USB-RS485 адаптера: серийный номер, если он есть, иначе имя порта.
+    Список портов перечисляется только для незнакомого имени, а не при каждом вызове
+    """
+    with adapter_lock:
+        if port_name not in adapter_ids:
+            from serial.tools import list_ports
+            for com_port in list_ports.comports():
+                adapter_ids.setdefault(com_port.device, com_port.serial_number or com_port.device)
+            adapter_ids.setdefault(port_name, port_name)
+        return adapter_ids[port_name]
+
+
+class DiscoveryCache(object):
+    """
+    Кэш найденного ранее: хост -> открытые порты Modbus, шина -> ответившие адреса,
+    адаптер -> настройки порта. Шина - ("tcp", host, port) или ("rtu", серийный номер адаптера).
+    У каждой записи время обнаружения, записи старше ttl секунд не используются
+    """
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        self.path = path or os.path.join(os.path.expanduser("~"), ".pressure_sensor_config.json")
+        self.ttl = ttl
+        self.lock = Lock()
+        self.data = {"ports": {}, "slaves": {}, "framing": {}}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+            self.data["ports"].update(data.get("ports", {}))
+            self.data["slaves"].update(data.get("slaves", {}))
+            self.data["framing"].update(data.get("framing", {}))
+        except (OSError, ValueError):
+            pass
+
+    def fresh(self, entries):
+        now = time.time()
+        return sorted(int(value) for value, found in entries.items() if now - found <= self.ttl)
+
+    def ports(self, host):
+        with self.lock:
+            return self.fresh(self.data["ports"].get(host, {}))
+
+    def slaves(self, key):
+        with self.lock:
+            return self.fresh(self.data["slaves"].get("/".join(str(part) for part in key), {}))
+
+    def add_ports(self, host, ports):
+        with self.lock:
+            entries = self.data["ports"].setdefault(host, {})
+            for port in ports:
+                entries[str(port)] = time.time()
+            self.save()
+
+    def add_slaves(self, key, slaves):
+        with self.lock:
+            entries = self.data["slaves"].setdefault("/".join(str(part) for part in key), {})
+            for slave in slaves:
+                entries[str(slave)] = time.time()
+            self.save()
+
+    def framing(self, adapter):
+        """
+        Настройки порта (скорость, четность, стоп-биты), на которых адаптер отвечал последний раз
+        """
+        with self.lock:
+            entry = self.data["framing"].get(adapter)
+            if entry is None or time.time() - entry[3] > self.ttl:
+                return None
+            return tuple(entry[:3])
+
+    def set_framing(self, adapter, framing):
+        with self.lock:
+            self.data["framing"][adapter] = list(framing) + [time.time()]
+            self.save()
+
+    def move_slave(self, key, old_address, new_address):
+        """
+        Датчик переадресован: старый адрес на шине больше не занят
+        """
+        with self.lock:
+            entries = self.data["slaves"].setdefault("/".join(str(part) for part in key), {})
+            entries.pop(str(old_address), None)
+            entries[str(new_address)] = time.time()
+            self.save()
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(self.data, file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+
+HEALTH_UNKNOWN = 0
+HEALTH_OK = 1
+HEALTH_TIMEOUT = 2
+HEALTH_ERROR = 3
+HEALTH_DUPLICATE = 4
+HEALTH_NAMES = ("unknown", "ok", "timeout", "error", "duplicate")
+
+
+class DeviceRecord(object):
+    """
+    Запись инвентаря о датчике (копия строки, изменения в инвентарь не попадают)
+    """
+    __slots__ = ("transport", "endpoint", "slave", "last_seen", "config_hash", "health")
+
+    def __init__(self, transport, endpoint, slave, last_seen, config_hash, health):
+        self.transport = transport
+        self.endpoint = endpoint
+        self.slave = slave
+        self.last_seen = last_seen
+        self.config_hash = config_hash
+        self.health = health
+
+    def to_dict(self):
+        return {"transport": self.transport, "endpoint": self.endpoint, "slave": self.slave,
+                "last_seen": self.last_seen, "config_hash": "{0:016x}".format(self.config_hash),
+                "health": HEALTH_NAMES[self.health]}
+
+
+class Inventory(object):
+    """
+    Инвентарь датчиков парка: строки хранятся по столбцам в массивах array
+    (шина, адрес, время последнего ответа, хэш конфигурации, состояние).
+    Шина - ключ как в DiscoveryCache: ("tcp", host, port) или ("rtu", серийный номер адаптера).
+    Индексы: шина -> {адрес: строка} и адрес -> множество шин, поиск и проверка занятости адреса за O(1).
+    Файл: заголовок, список шин (JSON) и столбцы подряд, читается через mmap без разбора строк
+    """
+    magic = b"415I"
+    header = struct.Struct("<4sHII")
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(os.path.expanduser("~"), ".pressure_sensor_inventory.bin")
+        self.lock = RLock()
+        self.buses = []
+        self.bus_ids = {}
+        self.bus_column = array("I")
+        self.slave_column = array("B")
+        self.health_column = array("B")
+        self.seen_column = array("d")
+        self.hash_column = array("Q")
+        self.by_bus = {}
+        self.by_address = {}
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.by_bus.values())
+
+    def bus_id(self, key):
+        key = tuple(key)
+        bus = self.bus_ids.get(key)
+        if bus is None:
+            bus = self.bus_ids[key] = len(self.buses)
+            self.buses.append(key)
+        return bus
+
+    def add_row(self, bus, slave, last_seen, config_hash, health):
+        row = len(self.slave_column)
+        self.bus_column.append(bus)
+        self.slave_column.append(slave)
+        self.seen_column.append(last_seen)
+        self.hash_column.append(config_hash)
+        self.health_column.append(health)
+        self.by_bus.setdefault(bus, {})[slave] = row
+        self.by_address.setdefault(slave, set()).add(bus)
+        return row
+
+    def record(self, row):
+        key = self.buses[self.bus_column[row]]
+        return DeviceRecord(key[0], ":".join(str(part) for part in key[1:]), self.slave_column[row],
+                            self.seen_column[row], self.hash_column[row], self.health_column[row])
+
+    def seen(self, key, slaves, health=HEALTH_OK, config_hash=None):
+        """
+        Датчики slaves ответили на шине key: добавляем или обновляем строки
+        """
+        now = time.time()
+        with self.lock:
+            bus = self.bus_id(key)
+            rows = self.by_bus.get(bus, {})
+            for slave in slaves:
+                row = rows.get(slave)
+                if row is None:
+                    self.add_row(bus, slave, now, config_hash or 0, health)
+                    rows = self.by_bus[bus]
+                    continue
+                self.seen_column[row] = now
+                self.health_column[row] = health
+                if config_hash is not None:
+                    self.hash_column[row] = config_hash
+
+    def set_health(self, key, slave, health):
+        with self.lock:
+            row = self.by_bus.get(self.bus_ids.get(tuple(key)), {}).get(slave)
+            if row is not None:
+                self.health_column[row] = health
+
+    def find(self, key, slave):
+        with self.lock:
+            row = self.by_bus.get(self.bus_ids.get(tuple(key)), {}).get(slave)
+            return None if row is None else self.record(row)
+
+    def taken(self, key, slave):
+        """
+        Занят ли адрес slave на шине key по данным инвентаря
+        """
+        with self.lock:
+            bus = self.bus_ids.get(tuple(key))
+            return bus is not None and bus in self.by_address.get(slave, ())
+
+    def on_bus(self, key):
+        with self.lock:
+            rows = self.by_bus.get(self.bus_ids.get(tuple(key)), {})
+            return [self.record(row) for _, row in sorted(rows.items())]
+
+    def with_address(self, slave):
+        """
+        Все датчики парка с адресом slave (например, не переадресованные с заводского адреса)
+        """
+        with self.lock:
+            return [self.record(self.by_bus[bus][slave]) for bus in sorted(self.by_address.get(slave, ()))]
+
+    def free_addresses(self, key):
+        with self.lock:
+            used = self.by_bus.get(self.bus_ids.get(tuple(key)), {})
+            return [slave for slave in range(1, 248) if slave not in used]
+
+    def duplicates(self):
+        """
+        Адреса, на которых при опросе отвечало несколько датчиков сразу
+        """
+        with self.lock:
+            return [self.record(row) for rows in self.by_bus.values() for row in rows.values()
+                    if self.health_column[row] == HEALTH_DUPLICATE]
+
+    def remove(self, key, slave):
+        """
+        Убираем строку из индексов; место в столбцах освобождается при сохранении
+        """
+        with self.lock:
+            bus = self.bus_ids.get(tuple(key))
+            if self.by_bus.get(bus, {}).pop(slave, None) is not None:
+                self.by_address[slave].discard(bus)
+
+    def move(self, key, old_address, new_address):
+        """
+        Датчик переадресован. Возвращаем False, если новый адрес уже числился за другим датчиком
+        """
+        with self.lock:
+            existing = self.find(key, new_address)
+            row = self.by_bus.get(self.bus_ids.get(tuple(key)), {}).get(old_address)
+            config_hash = self.hash_column[row] if row is not None else None
+            self.remove(key, old_address)
+            self.remove(key, new_address)
+            self.seen(key, [new_address], config_hash=config_hash)
+            return existing is None
+
+    def save(self):
+        """
+        Сохраняем живые строки столбцами; запись во временный файл и замена, как у DiscoveryCache
+        """
+        with self.lock:
+            rows = sorted(row for rows in self.by_bus.values() for row in rows.values())
+            buses = json.dumps([list(key) for key in self.buses]).encode("utf-8")
+            columns = [array(column.typecode, (column[row] for row in rows))
+                       for column in (self.bus_column, self.slave_column, self.health_column,
+                                      self.seen_column, self.hash_column)]
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(self.header.pack(self.magic, 1, len(rows), len(buses)))
+                file.write(buses)
+                for column in columns:
+                    column.tofile(file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Читаем инвентарь: столбцы копируются из отображенного в память файла целиком, без разбора строк
+        """
+        inventory = cls(path)
+        try:
+            with open(inventory.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, count, buses_size = cls.header.unpack_from(data, 0)
+                if magic != cls.magic or version != 1:
+                    return inventory
+                view = memoryview(data)
+                pos = cls.header.size
+                inventory.buses = [tuple(key) for key in json.loads(bytes(view[pos:pos + buses_size]))]
+                pos += buses_size
+                for column in (inventory.bus_column, inventory.slave_column, inventory.health_column,
+                               inventory.seen_column, inventory.hash_column):
+                    column.frombytes(view[pos:pos + count * column.itemsize])
+                    pos += count * column.itemsize
+                view.release()
+        except (OSError, ValueError, struct.error):
+            return cls(path)
+        inventory.bus_ids = {key: bus for bus, key in enumerate(inventory.buses)}
+        for row, (bus, slave) in enumerate(zip(inventory.bus_column, inventory.slave_column)):
+            inventory.by_bus.setdefault(bus, {})[slave] = row
+            inventory.by_address.setdefault(slave, set()).add(bus)
+        return inventory
+
+
+def load_profile(path):
+    """
+    Читаем профиль конфигурации: JSON объект {имя поля карты регистров: значение}.
+    Записывать можно только поля таблицы holding, адрес датчика профилем не меняется
+    """
+    with open(path, encoding="utf-8") as file:
+        profile = json.load(file, object_pairs_hook=OrderedDict)
+    if not isinstance(profile, dict):
+        raise ValueError("Профиль должен быть JSON объектом {поле: значение}")
+    for name, value in profile.items():
+        field = find_field(name)
+        if field[1] != "holding" or field[2] == 249:
+            raise ValueError("Поле {0} нельзя записать профилем".format(name))
+        fmt = field[3]
+        # Значение должно точно укладываться в формат поля: дробные числа в целые поля не усекаем
+        if isinstance(value, bool) or not isinstance(value, int if fmt != "f" else (int, float)):
+            raise ValueError("Поле {0}: значение {1!r} не подходит к формату {2}".format(name, value, fmt))
+        try:
+            struct.pack(">" + fmt, value)
+        except (struct.error, OverflowError):
+            raise ValueError("Поле {0}: значение {1} вне диапазона формата {2}".format(name, value, fmt))
+    return profile
+
+
+def profile_blocks(profile, max_count=123):
+    """
+    Кодируем значения профиля в регистры и объединяем их в непрерывные блоки записи
+    (без разрывов - чужие регистры не перезаписываем), блок не длиннее max_count (предел PDU)
+    """
+    registers = {}
+    for name, value in profile.items():
+        _, _, address, fmt = find_field(name)
+        value = float(value) if fmt == "f" else int(value)
+        words = struct.unpack(">" + "H" * field_size(fmt), struct.pack(">" + fmt, value))
+        for num, word in enumerate(words):
+            registers[address + num] = word
+    blocks = []
+    for address in sorted(registers):
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == address and len(blocks[-1][1]) < max_count:
+            blocks[-1][1].append(registers[address])
+        else:
+            blocks.append((address, [registers[address]]))
+    return blocks
+
+
+def push_config(device, slave, profile, blocks):
+    """
+    Записываем блоки профиля в датчик slave и проверяем укрупненным чтением.
+    Возвращаем "ok", "mismatch" (прочитано не то, что записано) или "error"
+    """
+    try:
+        for address, values in blocks:
+            if len(values) == 1:
+                device.execute(slave, mb_def.WRITE_SINGLE_REGISTER, address, output_value=values[0])
+            else:
+                device.execute(slave, mb_def.WRITE_MULTIPLE_REGISTERS, address, output_value=values)
+        fields = [find_field(name) for name in profile]
+        registers = {}
+        for _, address, count in plan_blocks(fields, max_gap=0):
+            for num, value in enumerate(device.execute(slave, mb_def.READ_HOLDING_REGISTERS, address, count)):
+                registers[address + num] = value
+    except (socket.error, serial.serialutil.SerialException, modbus_tk.exceptions.ModbusError,
+            modbus_tk.exceptions.ModbusInvalidResponseError, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
+        return "error"
+    for address, values in blocks:
+        if [registers.get(address + num) for num in range(len(values))] != values:
+            return "mismatch"
+    return "ok"
+
+
+class BusLimiter(object):
+    """
+    Ограничение числа одновременных операций на одной шине (для RS-485 и шлюзов - одна)
+    """
+    def __init__(self, limit=1):
+        self.limit = limit
+        self.lock = Lock()
+        self.semaphores = {}
+
+    @contextmanager
+    def acquire(self, bus):
+        with self.lock:
+            if bus not in self.semaphores:
+                self.semaphores[bus] = BoundedSemaphore(self.limit)
+            semaphore = self.semaphores[bus]
+        with semaphore:
+            yield
+
+
+def push_profile(targets, profile, per_bus=1, workers=32, on_result=None):
+    """
+    Рассылка профиля: targets - список (сессия шины, адреса датчиков).
+    Шины обрабатываются параллельно, на каждой не больше per_bus операций сразу.
+    on_result(шина, адрес, статус, длительность) вызывается по мере готовности.
+    Возвращаем [(шина, адрес, статус)]
+    """
+    blocks = profile_blocks(profile)
+    limiter = BusLimiter(per_bus)
+    results = []
+    results_lock = Lock()
+
+    def push(session, slave):
+        start = time.monotonic()
+        if abort.is_set():
+            status = "cancelled"
+        else:
+            with limiter.acquire(session.key):
+                if session.key[0] == "tcp":
+                    # Через очередь шлюза, без пробного подключения к каждому адресу
+                    device = session.scheduler().device(slave)
+                else:
+                    device = session.device or session.device_for(slave)
+                status = push_config(device, slave, profile, blocks)
+        with results_lock:
+            results.append((session.key, slave, status))
+        if on_result is not None:
+            on_result(session.key, slave, status, time.monotonic() - start)
+
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = [(session, slave) for session, slaves in targets for slave in slaves]
+    with abort.running(), ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as executor:
+        for future in [executor.submit(push, session, slave) for session, slave in jobs]:
+            future.result()
+    return results
+
+
+def parse_endpoint(endpoint, default_port=502):
+    """
+    Разбираем "host:port" в (host, port); имя хоста приводим к нижнему регистру,
+    чтобы разные написания одного шлюза ("10.0.0.5" и "10.0.0.5:502") давали один ключ шины
+    """
+    host, _, port = endpoint.strip().rpartition(":")
+    if not host:
+        return endpoint.strip().lower(), default_port
+    port = int(port)
+    if not 1 <= port <= 65535:
+        raise ValueError("порт {0} не в диапазоне от 1 до 65535".format(port))
+    return host.lower(), port
+
+
+def manifest_bus(row):
+    """
+    Ключ шины строки манифеста, как в SessionPool: ("tcp", host, port) или ("rtu", имя COM порта)
+    """
+    if row["transport"] == "tcp":
+        return ("tcp",) + parse_endpoint(row["endpoint"])
+    return "rtu", row["endpoint"]
+
+
+def read_manifest(path, readdress=True):
+    """
+    Читаем манифест пакетной переадресации (CSV с заголовком или JSON список).
+    Поля строки: transport (rtu/tcp), endpoint (COM порт или host:port), address, new_address.
+    readdress=False - манифест рассылки профиля, new_address не нужен
+    """
+    with open(path, encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".json"):
+            rows = json.load(file)
+        else:
+            rows = list(csv.DictReader(file))
+    manifest = []
+    for num, row in enumerate(rows, 1):
+        transport = str(row["transport"]).strip().lower()
+        if transport not in ("rtu", "tcp"):
+            raise ValueError("Строка {0}: неизвестный тип подключения {1}".format(num, row["transport"]))
+        addresses = [int(row["address"])] + ([int(row["new_address"])] if readdress else [])
+        for value in addresses:
+            if value < 1 or value > 247:
+                raise ValueError("Строка {0}: адрес {1} не в диапазоне от 1 до 247".format(num, value))
+        endpoint = str(row["endpoint"]).strip()
+        if transport == "tcp":
+            try:
+                parse_endpoint(endpoint)
+            except ValueError:
+                raise ValueError("Строка {0}: неверный адрес шлюза {1}".format(num, endpoint))
+        manifest.append(dict({"row": num, "transport": transport, "endpoint": endpoint,
+                              "address": addresses[0]}, **({"new_address": addresses[1]} if readdress else {})))
+    return manifest
+
+
+class BatchResults(object):
+    """
+    Файл результатов пакетной переадресации, строки дописываются по мере готовности
+    """
+    fields = ["row", "transport", "endpoint", "address", "new_address", "status", "duration"]
+
+    def __init__(self, path, fields=None):
+        self.fields = fields or self.fields
+        self.lock = Lock()
+        self.file = open(path, "w", encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fields)
+        self.writer.writeheader()
+        self.statuses = {}
+
+    def add(self, row, status, duration):
+        with self.lock:
+            self.writer.writerow(dict(row, status=status, duration="{0:.3f}".format(duration)))
+            self.file.flush()
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def close(self):
+        self.file.close()
+
 
-class Device(mb_rtu.RtuMaster):
+def readdress_row(row, session):
     """
-    Экземпляр устройства в сети по протоколу ModbusRTU
+    Переадресация одного датчика из манифеста. Возвращаем статус строки
     """
-    def __init__(self, port, slave=None):
-        super(Device, self).__init__(serial=port)
-        self.slave = slave
-        self.is_connect = False
-        self.set_timeout(0.1)
-        self.stop_search = False
-        self.thread1 = Thread(target=self.wait_exit, daemon=True)
-        self.thread1.start()
-        self.try_connect()
+    device = session.device_for(row["address"])
+    if not device.check_connect():
+        if inventory is not None:
+            inventory.set_health(device.cache_key(), row["address"], HEALTH_TIMEOUT)
+        return "not_found"
+    if inventory is not None and inventory.taken(device.cache_key(), row["new_address"]):
+        # По инвентарю новый адрес занят - проверяем на шине, чтобы не получить два датчика с одним адресом
+        if device.check_slave(row["new_address"]):
+            return "address_taken"
+        inventory.remove(device.cache_key(), row["new_address"])
+        device.slave = row["address"]
+    device.write_slave(row["new_address"])
+    if device.slave != row["new_address"]:
+        return "write_failed"
+    return "ok"
+
 
-    def wait_exit(self):
+def run_bus(key, rows, results, sessions):
+    """
+    Последовательно обрабатываем строки одной шины (COM порта или шлюза) через одно подключение.
+    Устройство сессии меняет адрес датчика на каждой строке, поэтому на шину - ровно один поток
+    """
+    if key[0] == "tcp":
+        session = sessions.tcp(key[1], key[2])
+    else:
+        session = sessions.rtu(key[1])
+    if session is None:
+        for row in rows:
+            results.add(row, "port_failed", 0.0)
+        return
+    for row in rows:
+        if abort.is_set():
+            results.add(row, "cancelled", 0.0)
+            continue
+        start = time.monotonic()
         try:
-            keyboard.wait("esc")
-            self.stop_search = True
-        except KeyError:
-            self.stop_search = True
+            if not session.check():
+                status = "port_failed"
+            else:
+                status = readdress_row(row, session)
+        except (socket.error, serial.serialutil.SerialException, modbus_tk.exceptions.ModbusError,
+                modbus_tk.exceptions.ModbusInvalidResponseError, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
+            # Шлюз, принявший подключение и закрывший его, дает пустой ответ - ошибка строки, а не всей шины
+            status = "error"
+        results.add(row, status, time.monotonic() - start)
 
-    def try_connect(self):
-        if self.slave is None:
-            print("\nНажмите [ Esc ] чтобы прервать процесс поиска")
-            devices = range(1, 248)
-            for device in devices:
-                if self.stop_search:
-                    break
-                if self.check_connect():
-                    break
-                self.slave = device
-                print("\nПытаемся подключиться к датчику по адресу", self.slave, end="")
-                err_cnt = 0
-                while err_cnt < 10:
-                    print(" .", end="", flush=True)
-                    try:
-                        get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
-                        if get_data[0] == self.slave:
-                            self.is_connect = True
-                            print()
-                            border_print("Подключились к датчику по адресу " + str(self.slave), "#")
-                            break
-                    except modbus_tk.exceptions.ModbusInvalidResponseError:
-                        self.is_connect = False
-                    err_cnt += 1
-        else:
-            print("\nПытаемся подключиться к датчику по адресу", self.slave, end="")
-            err_cnt = 0
-            while err_cnt < 10:
-                print(" .", end="", flush=True)
-                try:
-                    get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
-                    if get_data[0] == self.slave:
-                        self.is_connect = True
-                        print()
-                        border_print("Подключились к датчику по адресу " + str(self.slave), "#")
-                        break
-                except modbus_tk.exceptions.ModbusInvalidResponseError:
-                    self.is_connect = False
-                err_cnt += 1
-        if not self.is_connect:
-            print()
-            border_print("Подключиться не удалось", "!")
 
-    def check_connect(self):
-        return self.is_connect
+def batch_readdress(manifest, result_path, max_buses=32):
+    """
+    Пакетная переадресация: одна очередь на каждую шину, шины обрабатываются параллельно
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    buses = OrderedDict()
+    for row in manifest:
+        # Группируем по ключу сессии: разные написания одного шлюза - одна очередь, а не два потока на устройстве
+        buses.setdefault(manifest_bus(row), []).append(row)
+    results = BatchResults(result_path)
+    sessions = SessionPool(max_size=len(buses))
+    try:
+        with abort.running(), ThreadPoolExecutor(max_workers=max(1, min(max_buses, len(buses)))) as executor:
+            for future in [executor.submit(run_bus, key, rows, results, sessions) for key, rows in buses.items()]:
+                future.result()
+    finally:
+        sessions.close_all()
+        results.close()
+    return results.statuses
 
-    def write_slave(self, new_address):
-        old_address = self.slave
 
-        if new_address is not None and new_address > 0 and new_address != old_address:
-            print("\nПишем новый адрес " + str(new_address) + " в устройство", end="")
-            try_cnt = 0
-            while try_cnt < 10:
-                print(" .", end="", flush=True)
-                try:
-                    self.execute(self.slave, mb_def.WRITE_SINGLE_REGISTER, 249, 1, new_address)
-                except modbus_tk.exceptions.ModbusInvalidResponseError:
-                    try_cnt += 1
-            print()
-            self.slave = new_address
-            if not self.try_new_slave():
-                self.slave = old_address
-        else:
-            border_print("Адрес датчика не изменен", "#")
+def batch_main(argv):
+    global cache, inventory
+    parser = argparse.ArgumentParser(description="Пакетная переадресация датчиков 415М-ДИ по манифесту")
+    parser.add_argument("manifest", help="CSV или JSON файл: transport, endpoint, address, new_address")
+    parser.add_argument("-o", "--output", default="results.csv", help="файл результатов (CSV)")
+    parser.add_argument("-j", "--buses", type=int, default=32, help="число шин, обрабатываемых одновременно")
+    cli_options(parser)
+    args = parser.parse_args(argv)
+    try:
+        manifest = read_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as err:
+        border_print("ERROR: манифест не прочитан: " + str(err), "!")
+        return 1
+    cache = DiscoveryCache()
+    inventory = Inventory.load()
+    watch_abort(esc=False)
+    if args.metrics:
+        enable_metrics()
+    if args.capture:
+        enable_capture(args.capture)
+    statuses = batch_readdress(manifest, args.output, args.buses)
+    disable_capture()
+    inventory.save()
+    if args.metrics:
+        metrics.save(args.metrics)
+    border_print(["ПАКЕТНАЯ ПЕРЕАДРЕСАЦИЯ ЗАВЕРШЕНА"] +
+                 ["{0}: {1}".format(status, count) for status, count in sorted(statuses.items())] +
+                 ["Результаты: " + args.output], "#")
+    return 0 if statuses.get("ok", 0) == len(manifest) else 1
 
-    def try_new_slave(self):
-        err_cnt = 0
-        while err_cnt < 10:
-            try:
-                get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
-                if get_data[0] == self.slave:
-                    self.is_connect = True
-                    border_print("Новый адрес датчика записан", "#")
-                    break
-                # print(get_data[0])
-            except modbus_tk.exceptions.ModbusInvalidResponseError:
-                self.is_connect = False
-            err_cnt += 1
-        if not self.is_connect:
-            border_print("Запись не удалась", "!")
-            return False
-        return True
+
+def cli_options(parser):
+    """
+    Общие параметры подкоманд, пакетного режима и службы: запись кадров и статистика транзакций
+    """
+    parser.add_argument("--capture", help="файл записи кадров Modbus (дописывается)")
+    parser.add_argument("--metrics", help="файл статистики транзакций (.prom - Prometheus, иначе JSON lines)")
+    return parser
 
 
-class TcpDevice(mb_tcp.TcpMaster):
+def cli_setup(args, sessions=1):
     """
-    Экземпляр устройства в сети по протоколу ModbusTCP
+    Общий запуск подкоманд: без меню и без перехвата Esc (модулю keyboard нужен root)
     """
-    def __init__(self, host, port, slave=None):
-        super(TcpDevice, self).__init__(host=host, port=port, timeout_in_sec=0.25)
-        self.slave = slave
-        self.is_connect = False
-        # self.set_timeout(0.25)
-        self.stop_search = False
-        self.thread1 = Thread(target=self.wait_exit, daemon=True)
-        self.thread1.start()
-        self.try_connect()
+    global pool, cache, inventory
+    pool = SessionPool(max_size=sessions)
+    cache = DiscoveryCache()
+    inventory = Inventory.load()
+    watch_abort(esc=False)
+    if args.metrics:
+        enable_metrics()
+    if args.capture:
+        enable_capture(args.capture)
 
-    def wait_exit(self):
+
+def cli_session(transport, endpoint):
+    """
+    Сессия шины подкоманды: transport "tcp" и endpoint "host:port" или "rtu" и имя COM порта; None - нет подключения
+    """
+    if transport == "tcp":
         try:
-            keyboard.wait("esc")
-            self.stop_search = True
-        except KeyError:
-            self.stop_search = True
+            host, port = parse_endpoint(endpoint)
+        except ValueError:
+            border_print("ERROR: неверный адрес шлюза " + endpoint, "!")
+            return None
+        return pool.tcp(host, port)
+    return pool.rtu(endpoint)
 
-    def try_connect(self):
-        if self.slave is None:
-            print("\nНажмите [ Esc ] чтобы прервать процесс поиска")
-            devices = range(1, 248)
-            for device in devices:
-                if self.stop_search:
-                    break
-                if self.check_connect():
-                    break
-                self.slave = device
-                print("\nПытаемся подключиться к датчику по адресу", self.slave, end="")
-                err_cnt = 0
-                while err_cnt < 10:
-                    print(" .", end="", flush=True)
-                    try:
-                        get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
-                        if get_data[0] == self.slave:
-                            self.is_connect = True
-                            print()
-                            border_print("Подключились к датчику по адресу " + str(self.slave), "#")
-                            break
-                    except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
-                        self.is_connect = False
-                    err_cnt += 1
-        else:
-            print("\nПытаемся подключиться к датчику по адресу", self.slave, end="")
-            err_cnt = 0
-            while err_cnt < 10:
-                print(" .", end="", flush=True)
-                try:
-                    get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
-                    if get_data[0] == self.slave:
-                        self.is_connect = True
-                        print()
-                        border_print("Подключились к датчику по адресу " + str(self.slave), "#")
-                        break
-                except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
-                    self.is_connect = False
-                err_cnt += 1
-        if not self.is_connect:
-            print()
-            border_print("Подключиться не удалось", "!")
 
-    def check_connect(self):
-        return self.is_connect
+def cli_start(argv, parser):
+    """
+    Запуск подкоманд одной шины (scan, readdress)
+    """
+    args = parser.parse_args(argv)
+    cli_setup(args)
+    return args, cli_session(args.transport, args.endpoint)
 
-    def write_slave(self, new_address):
-        old_address = self.slave
 
-        if new_address is not None and new_address > 0 and new_address != old_address:
-            print("\nПишем новый адрес " + str(new_address) + " в устройство", end="")
-            try_cnt = 0
-            while try_cnt < 10:
-                print(" .", end="", flush=True)
-                try:
-                    self.execute(self.slave, mb_def.WRITE_SINGLE_REGISTER, 249, 1, new_address)
-                except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
-                    try_cnt += 1
-            print()
-            self.slave = new_address
-            if not self.try_new_slave():
-                self.slave = old_address
-        else:
-            border_print("Адрес датчика не изменен", "#")
+def cli_finish(args):
+    pool.close_all()
+    disable_capture()
+    inventory.save()
+    if args.metrics:
+        metrics.save(args.metrics)
 
-    def try_new_slave(self):
-        err_cnt = 0
-        while err_cnt < 10:
-            try:
-                get_data = self.execute(self.slave, mb_def.READ_HOLDING_REGISTERS, 249, 1)
-                if get_data[0] == self.slave:
-                    self.is_connect = True
-                    border_print("Новый адрес датчика записан", "#")
-                    break
-            except (socket.timeout, modbus_tk.modbus_tcp.ModbusInvalidMbapError):
-                self.is_connect = False
-            err_cnt += 1
-        if not self.is_connect:
-            border_print("Запись не удалась", "!")
-            return False
-        return True
 
+def cli_parser(command, description):
+    parser = argparse.ArgumentParser(prog="main.py " + command, description=description)
+    parser.add_argument("transport", choices=("tcp", "rtu"), help="tcp - шлюз Modbus TCP, rtu - COM порт")
+    parser.add_argument("endpoint", help="host:port шлюза или имя COM порта")
+    return cli_options(parser)
 
-def get_int(message="", name="", minimum=0, maximum=65535, zero_exit=False):
+
+def slave_arg(value):
+    slave = int(value)
+    if not 1 <= slave <= 247:
+        raise argparse.ArgumentTypeError("адрес датчика от 1 до 247")
+    return slave
+
+
+def parse_target(text):
     """
-    Функция проверяет введенные пользователем данные на int и принадлежность к диапазону
+    Шина и адреса датчиков из аргумента: tcp://host:port/1,2,3 или rtu://COM3/1,2 (rtu:///dev/ttyUSB0/1)
     """
-    while True:
-        try:
-            line = input(message)
-            if not line:
-                return None
-            usr_int = int(line)
-            if zero_exit and usr_int == 0:
-                return "quit"
-            elif not zero_exit and usr_int == 0:
-                return None
-            if maximum < usr_int or usr_int < minimum:
-                raise _RangeError("{0} не в диапазоне от {1} до {2}.".format(name, minimum, maximum))
-            return usr_int
-        except _RangeError as err:
-            border_print("ERROR:" + str(err), "!")
-        except ValueError:
-            border_print("ERROR: {0} не число".format(name), "!")
+    transport, sep, rest = text.partition("://")
+    endpoint, _, slaves = rest.rpartition("/")
+    if not sep or transport not in ("tcp", "rtu") or not endpoint:
+        raise argparse.ArgumentTypeError("ожидается tcp://host:port/адреса или rtu://порт/адреса: " + text)
+    try:
+        return transport, endpoint, [slave_arg(slave) for slave in slaves.split(",")]
+    except (ValueError, argparse.ArgumentTypeError):
+        raise argparse.ArgumentTypeError("адреса датчиков - числа от 1 до 247 через запятую: " + text)
 
 
-def programm_exit():
+def scan_main(argv):
     """
-    Закрываем порты перед окончанием программы
+    main.py scan tcp|rtu endpoint - поиск датчиков на шине. Код возврата 0, если ответил хотя бы один
     """
-    global port_obj
-    if port_obj is not None:
-        port_obj.close()
-        if not port_obj.check_ports():
-            border_print(["Программа завершена", " нажмите [ Ввод ]"], "*")
-    else:
-        border_print(["Программа завершена", " нажмите [ Ввод ]"], "*")
-    input()
+    args, session = cli_start(argv, cli_parser("scan", "Поиск датчиков 415М-ДИ на шине"))
+    slaves = []
+    try:
+        if session is not None:
+            with abort.running():
+                device = session.device_for(None)
+                if session.key[0] == "rtu" and not device.check_connect() and session.transport.autodetect():
+                    session.device = None
+                    device = session.device_for(None)
+                slaves = device.slaves
+        if not slaves:
+            border_print("Датчики не найдены", "!")
+    finally:
+        cli_finish(args)
+    return 0 if slaves else 1
 
 
-def border_print(message, hor_sym, vert_sym=None):
+def readdress_main(argv):
     """
-    Делаем рамку вокруг сообщения
+    main.py readdress tcp|rtu endpoint address new_address - переадресация одного датчика
     """
-    print()
-    if vert_sym is None:
-        vert_sym = hor_sym
-    if type(message) == list:
-        max_len = 0
-        for mess in message:
-            if len(mess) > max_len:
-                max_len = len(mess)
-        print(hor_sym * (max_len + 4))
-        for num, mess in enumerate(message):
-            if num == 0:
-                print(vert_sym + " " * (((max_len + 2) - len(mess)) // 2) + mess +
-                      " " * (((max_len + 2) - len(mess)) - ((max_len + 2) - len(mess)) // 2) + vert_sym)
-            else:
-                print(vert_sym + " " + mess + " " * (max_len - len(mess) + 1) + vert_sym)
-        print(hor_sym * (max_len + 4))
-    else:
-        print(hor_sym * (len(message) + 4))
-        print(vert_sym + " " + message + " " + vert_sym)
-        print(hor_sym * (len(message) + 4))
+    parser = cli_parser("readdress", "Переадресация датчика 415М-ДИ")
+    parser.add_argument("address", type=slave_arg, help="текущий адрес датчика")
+    parser.add_argument("new_address", type=slave_arg, help="новый адрес датчика")
+    args, session = cli_start(argv, parser)
+    status = "not_connected"
+    try:
+        if session is not None:
+            with abort.running():
+                status = readdress_row({"address": args.address, "new_address": args.new_address}, session)
+    finally:
+        cli_finish(args)
+    if status != "ok":
+        border_print("ERROR: переадресация не выполнена: " + status, "!")
+    return 0 if status == "ok" else 1
 
 
-def get_bool(message="\nСконфигурировать новый датчик? (да/д/yes/y): ", lst=None):
+def poll_main(argv):
     """
-    Возвращаем подтверждение от пользователя
+    main.py poll tcp://host:port/1,2 ... - непрерывный опрос поля карты регистров, отсчеты в файл -o
     """
-    if lst is None:
-        lst = ["да", "д", "y", "yes"]
-    yes = frozenset(lst)
-    line = input(message)
-    return line.lower() in yes
+    parser = argparse.ArgumentParser(prog="main.py poll", description="Непрерывный опрос датчиков 415М-ДИ")
+    parser.add_argument("targets", nargs="+", type=parse_target, metavar="target",
+                        help="шина и адреса датчиков: tcp://host:port/1,2,3 или rtu://COM3/1,2")
+    parser.add_argument("--register-map", help="JSON файл карты регистров")
+    parser.add_argument("--field", default="pressure", help="опрашиваемое поле карты регистров")
+    parser.add_argument("--interval", type=float, default=0.1, help="период опроса, с")
+    parser.add_argument("--duration", type=float, help="длительность опроса, с (по умолчанию - до Ctrl+C)")
+    parser.add_argument("-o", "--output", help="файл отсчетов (.csv - текст, иначе двоичные записи)")
+    cli_options(parser)
+    args = parser.parse_args(argv)
+    try:
+        if args.register_map:
+            load_register_map(args.register_map)
+        find_field(args.field)
+    except (OSError, ValueError) as err:
+        border_print("ERROR: карта регистров не прочитана: " + str(err), "!")
+        return 1
+    except KeyError as err:
+        border_print(["ERROR: " + err.args[0], "Укажите карту регистров с этим полем: --register-map файл.json"], "!")
+        return 1
+    cli_setup(args, len(args.targets))
+    try:
+        targets = []
+        for transport, endpoint, slaves in args.targets:
+            session = cli_session(transport, endpoint)
+            if session is None:
+                return 1
+            targets.append((session, slaves))
+        print("\nОпрашиваем поле {0}, Ctrl+C - остановить".format(args.field), flush=True)
+        with abort.running():
+            stats = poll_sensors(targets, args.field, args.interval, args.duration, args.output)
+    finally:
+        cli_finish(args)
+    border_print(["ОПРОС ЗАВЕРШЕН"] +
+                 ["{bus}: отсчетов {samples}, ошибок {errors}, пропущено сроков {missed}, {rate:.1f} отсч./с".format(
+                     **item) for item in stats] +
+                 (["Отсчеты: " + args.output] if args.output else []), "#")
+    return 0 if all(item["samples"] for item in stats) else 1
 
 
-def get_host():
+def push_main(argv):
     """
-    Проверяем корректность введенного адреса
+    main.py push profile.json tcp://host:port/1,2 ... (или -m манифест) - рассылка профиля конфигурации
     """
-    correct_host = re.compile("([0-9]{1,3}[.]){3}[0-9]{1,3}")
-    while True:
-        host = input("\nВведите IP адрес:"
-                     "\n\t(пустое поле или 0 - выход из программы): ")
-        if not host or host == "0":
-            return "quit"
-        if re.match(correct_host, host):
-            return host
+    parser = argparse.ArgumentParser(prog="main.py push",
+                                     description="Рассылка профиля конфигурации датчикам 415М-ДИ")
+    parser.add_argument("profile", help="JSON профиль {поле карты регистров: значение}")
+    parser.add_argument("targets", nargs="*", type=parse_target, metavar="target",
+                        help="шина и адреса датчиков: tcp://host:port/1,2,3 или rtu://COM3/1,2")
+    parser.add_argument("-m", "--manifest", help="CSV или JSON файл: transport, endpoint, address")
+    parser.add_argument("-o", "--output", default="push_results.csv", help="файл результатов (CSV)")
+    parser.add_argument("--register-map", help="JSON файл карты регистров")
+    parser.add_argument("--per-bus", type=int, default=1, help="число одновременных записей на одной шине")
+    cli_options(parser)
+    args = parser.parse_args(argv)
+    try:
+        if args.register_map:
+            load_register_map(args.register_map)
+        profile = load_profile(args.profile)
+        rows = read_manifest(args.manifest, readdress=False) if args.manifest else []
+    except (OSError, ValueError, KeyError) as err:
+        reason = err.args[0] if isinstance(err, KeyError) else err
+        border_print("ERROR: профиль или манифест не прочитан: " + str(reason), "!")
+        return 1
+    for transport, endpoint, slaves in args.targets:
+        rows += [{"row": len(rows) + 1, "transport": transport, "endpoint": endpoint, "address": slave}
+                 for slave in slaves]
+    if not rows:
+        parser.error("нужны адреса датчиков: target или --manifest")
+    buses = OrderedDict()
+    for row in rows:
+        buses.setdefault((row["transport"], row["endpoint"].lower()), []).append(row)
+    cli_setup(args, len(buses))
+    results = BatchResults(args.output, ["row", "transport", "endpoint", "address", "status", "duration"])
+    try:
+        targets = []
+        by_slave = {}
+        for bus_rows in buses.values():
+            session = cli_session(bus_rows[0]["transport"], bus_rows[0]["endpoint"])
+            if session is None:
+                for row in bus_rows:
+                    results.add(row, "port_failed", 0.0)
+                continue
+            slaves = []
+            for row in bus_rows:
+                if (session.key, row["address"]) in by_slave:
+                    results.add(row, "duplicate", 0.0)
+                    continue
+                by_slave[(session.key, row["address"])] = row
+                slaves.append(row["address"])
+            targets.append((session, slaves))
+        push_profile(targets, profile, args.per_bus,
+                     on_result=lambda key, slave, status, duration: results.add(by_slave[(key, slave)], status,
+                                                                                  duration))
+    finally:
+        results.close()
+        cli_finish(args)
+    border_print(["РАССЫЛКА ПРОФИЛЯ ЗАВЕРШЕНА"] +
+                 ["{0}: {1}".format(status, count) for status, count in sorted(results.statuses.items())] +
+                 ["Результаты: " + args.output], "#")
+    return 0 if results.statuses.get("ok", 0) == len(rows) else 1
+
+
+class RpcError(Exception):
+    """
+    Ошибка вызова JSON-RPC: код по спецификации JSON-RPC 2.0 и сообщение
+    """
+    def __init__(self, code, message):
+        super(RpcError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def rpc_int(params, name, minimum=None, maximum=None, default=None):
+    value = params.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RpcError(-32602, "Параметр {0} должен быть целым числом".format(name))
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise RpcError(-32602, "Параметр {0} не в диапазоне от {1} до {2}".format(name, minimum, maximum))
+    return value
+
+
+def rpc_ints(params, name, minimum, maximum, default=None):
+    """
+    Параметр - непустой список целых чисел от minimum до maximum
+    """
+    values = params.get(name, default)
+    try:
+        if not isinstance(values, list) or not values:
+            raise TypeError(name)
+        values = [int(value) for value in values]
+    except (TypeError, ValueError):
+        raise RpcError(-32602, "Параметр {0} должен быть списком целых чисел".format(name))
+    if not all(minimum <= value <= maximum for value in values):
+        raise RpcError(-32602, "Параметр {0} - список чисел от {1} до {2}".format(name, minimum, maximum))
+    return values
+
+
+class ConfigService(object):
+    """
+    Методы службы конфигурирования. Подключения к шинам общие для всех клиентов (SessionPool).
+    COM порт и переадресация захватывают шину целиком (BusLimiter), чтение и опрос через шлюз
+    идут через его очередь транзакций с приоритетами (GatewayScheduler)
+    """
+    def __init__(self, max_sessions=32, max_duration=60.0):
+        self.pool = SessionPool(max_size=max_sessions)
+        self.limiter = BusLimiter(1)
+        self.max_duration = max_duration
+        self.methods = {"discover": self.discover, "read_config": self.read_config,
+                        "readdress": self.readdress, "poll": self.poll, "inventory": self.inventory,
+                        "metrics": self.metrics}
+
+    def bus_key(self, params):
+        """
+        Шина запроса: transport "tcp" и endpoint "host:port" или transport "rtu" и endpoint - имя COM порта
+        """
+        transport = str(params.get("transport", "tcp")).lower()
+        endpoint = params.get("endpoint")
+        if transport not in ("tcp", "rtu") or not endpoint:
+            raise RpcError(-32602, "Нужны параметры transport (tcp/rtu) и endpoint")
+        if transport == "tcp":
+            try:
+                host, port = parse_endpoint(str(endpoint))
+            except ValueError:
+                raise RpcError(-32602, "Неверный endpoint " + str(endpoint))
+            return "tcp", host, port
+        return "rtu", str(endpoint)
+
+    @contextmanager
+    def bus(self, params, timing, exclusive=True):
+        """
+        Выдаем сессию шины запроса; ожидание очереди к шине копится в timing["queued"].
+        COM порт всегда захватывается целиком, шлюз - только для exclusive операций,
+        остальные операции со шлюзом разделяют его через очередь транзакций (GatewayScheduler)
+        """
+        key = self.bus_key(params)
+        start = time.monotonic()
+        with self.limiter.acquire(key) if exclusive or key[0] == "rtu" else nullcontext():
+            timing["queued"] += time.monotonic() - start
+            session = self.pool.tcp(key[1], key[2]) if key[0] == "tcp" else self.pool.rtu(key[1])
+            if session is None:
+                raise RpcError(-32001, "Нет подключения к " + "/".join(str(part) for part in key))
+            yield session
+
+    def device(self, session, slave, priority=PRIORITY_CONFIG):
+        if session.key[0] == "tcp":
+            return session.scheduler().device(slave, priority)
+        device = session.device or session.device_for(slave)
+        device.slave = slave
+        return device
+
+    def scheduled(self, device, timing):
+        if isinstance(device, ScheduledDevice):
+            timing["queued"] += device.queued
+
+    def discover(self, params, timing):
+        """
+        network - поиск шлюзов в подсети или списке подсетей, host - поиск открытых портов,
+        endpoint - опрос адресов шины, без параметров - поиск датчиков на COM портах
+        """
+        if "network" in params:
+            networks = params["network"] if isinstance(params["network"], list) else [params["network"]]
+            try:
+                networks = [str(ipaddress.ip_network(str(network), strict=False)) for network in networks]
+            except ValueError as err:
+                raise RpcError(-32602, "Неверная подсеть: " + str(err))
+            ports = rpc_ints(params, "ports", 1, 65535, [502])
+            if gateway_targets(networks, ports) > GATEWAY_SCAN_LIMIT:
+                raise RpcError(-32602, "Поиск шире {0} адресов host:port".format(GATEWAY_SCAN_LIMIT))
+            return [{"host": host, "port": port, "status": status}
+                    for host, port, status in discover_gateways(networks, ports)]
+        if "host" in params:
+            first = rpc_int(params, "first", 1, 65535, 1)
+            last = rpc_int(params, "last", first, 65535, 65535)
+            return scan_ports(str(params["host"]), range(first, last + 1))
+        if "endpoint" in params:
+            slaves = range(rpc_int(params, "first", 1, 247, 1), rpc_int(params, "last", 1, 247, 247) + 1)
+            with self.bus(params, timing, exclusive=False) as session:
+                if session.key[0] == "tcp":
+                    return scan_slaves(session.scheduler(), slaves)
+                return self.device(session, slaves[0] if slaves else 1).enumerate_slaves(slaves)
+        from serial.tools import list_ports
+        slaves = rpc_ints(params, "slaves", 1, 247) if "slaves" in params else None
+        return [{"port": com_port.device, "slaves": found, "latency": latency}
+                for com_port, found, latency in probe_com_ports(remember_adapters(list_ports.comports()), slaves)]
+
+    def read_config(self, params, timing):
+        slave = rpc_int(params, "slave", 1, 247)
+        if "fields" in params and not isinstance(params["fields"], list):
+            raise RpcError(-32602, "Параметр fields - список имен полей")
+        try:
+            fields = [find_field(str(name)) for name in params["fields"]] if "fields" in params else None
+        except KeyError as err:
+            raise RpcError(-32602, str(err.args[0]))
+        with self.bus(params, timing, exclusive=False) as session:
+            device = self.device(session, slave)
+            try:
+                return read_snapshot(device, fields).to_dict()
+            finally:
+                self.scheduled(device, timing)
+
+    def readdress(self, params, timing):
+        slave = rpc_int(params, "slave", 1, 247)
+        new_address = rpc_int(params, "new_address", 1, 247)
+        with self.bus(params, timing) as session:
+            # Переадресация - несколько зависимых транзакций, выполняем ее напрямую, захватив шину
+            if session.key[0] == "tcp" and session.device is None:
+                session.scheduler()
+            device = session.device or session.device_for(slave)
+            device.slave = slave
+            if not device.check_slave(slave):
+                return {"status": "not_found", "slave": slave}
+            device.write_slave(new_address)
+            return {"status": "ok" if device.slave == new_address else "write_failed", "slave": device.slave}
+
+    def poll(self, params, timing):
+        """
+        Опрос поля field у датчиков slaves: count циклов раз в interval секунд.
+        Шина занимается на один цикл, между циклами ее могут использовать другие клиенты
+        """
+        slaves = rpc_ints(params, "slaves", 1, 247)
+        try:
+            field = find_field(str(params.get("field", "pressure")))
+        except KeyError as err:
+            raise RpcError(-32602, str(err.args[0]))
+        count = rpc_int(params, "count", 1, None, 1)
+        try:
+            interval = float(params.get("interval", 0.0))
+        except (TypeError, ValueError):
+            raise RpcError(-32602, "Параметр interval должен быть числом")
+        if not 0.0 <= interval <= self.max_duration:
+            raise RpcError(-32602, "Параметр interval не в диапазоне от 0 до {0}".format(self.max_duration))
+        if count * interval > self.max_duration:
+            raise RpcError(-32602, "Опрос длиннее {0} с".format(self.max_duration))
+        samples = []
+        for cycle in range(count):
+            start = time.monotonic()
+            with self.bus(params, timing, exclusive=False) as session:
+                device = self.device(session, slaves[0], PRIORITY_POLL)
+                for slave in slaves:
+                    try:
+                        samples.append([time.time(), slave, read_field(device, slave, field)])
+                    except (socket.error, modbus_tk.exceptions.ModbusError,
+                            modbus_tk.exceptions.ModbusInvalidResponseError,
+                            modbus_tk.modbus_tcp.ModbusInvalidMbapError):
+                        samples.append([time.time(), slave, None])
+                self.scheduled(device, timing)
+            if cycle + 1 < count:
+                time.sleep(max(0.0, interval - (time.monotonic() - start)))
+        return {"field": field[0], "samples": samples}
+
+    def inventory(self, params, timing):
+        """
+        Записи инвентаря: endpoint - датчики шины, slave - датчики с этим адресом по всему парку,
+        duplicates - адреса, на которых отвечало несколько датчиков
+        """
+        if inventory is None:
+            return []
+        if params.get("duplicates"):
+            records = inventory.duplicates()
+        elif "endpoint" in params:
+            key = self.bus_key(params)
+            if key[0] == "rtu":
+                key = ("rtu", adapter_id(key[1]))
+            records = inventory.on_bus(key)
+        elif "slave" in params:
+            records = inventory.with_address(rpc_int(params, "slave", 1, 247))
         else:
-            border_print("Ввод некорректен", "!")
+            raise RpcError(-32602, "Нужен параметр endpoint, slave или duplicates")
+        return [record.to_dict() for record in records]
+
+    def metrics(self, params, timing):
+        """
+        Статистика транзакций: format "json" (по умолчанию) - список рядов, "prometheus" - текст.
+        enable - начать учет, если служба запущена без --metrics
+        """
+        if params.get("enable"):
+            enable_metrics()
+        if metrics is None:
+            raise RpcError(-32002, "Статистика не ведется: запустите службу с --metrics или передайте enable")
+        fmt = str(params.get("format", "json"))
+        if fmt not in ("json", "prometheus"):
+            raise RpcError(-32602, "Параметр format - json или prometheus")
+        return metrics.prometheus() if fmt == "prometheus" else metrics.to_list()
+
+    def call(self, request):
+        """
+        Выполняем один вызов JSON-RPC 2.0, в ответ добавляем время выполнения
+        и ожидания очереди к шине (latency, queued, секунды)
+        """
+        start = time.monotonic()
+        timing = {"queued": 0.0}
+        response = {"jsonrpc": "2.0", "id": request.get("id") if isinstance(request, dict) else None}
+        try:
+            if not isinstance(request, dict) or request.get("method") not in self.methods:
+                raise RpcError(-32601, "Метод не найден")
+            params = request.get("params", {})
+            if not isinstance(params, dict):
+                raise RpcError(-32602, "Параметры передаются объектом")
+            response["result"] = self.methods[request["method"]](params, timing)
+        except RpcError as err:
+            response["error"] = {"code": err.code, "message": err.message}
+        except (OSError, ValueError, serial.serialutil.SerialException, modbus_tk.exceptions.ModbusError,
+                modbus_tk.exceptions.ModbusInvalidResponseError, modbus_tk.modbus_tcp.ModbusInvalidMbapError) as err:
+            response["error"] = {"code": -32000, "message": "{0}: {1}".format(type(err).__name__, err)}
+        except Exception as err:
+            # Ошибка одного вызова не должна обрывать подключение и терять остальные ответы пакета
+            response["error"] = {"code": -32603, "message": "{0}: {1}".format(type(err).__name__, err)}
+        response["latency"] = time.monotonic() - start
+        response["queued"] = timing["queued"]
+        return response
 
 
-def wait_esc():
+class RpcHandler(object):
     """
-    Ожидание esc для прерывания процесса
+    POST / - вызов JSON-RPC 2.0 (один или пакет), GET /health - состояние службы.
+    Примесь к BaseHTTPRequestHandler (см. daemon_main): http.server загружается только при запуске службы
     """
-    global port_search
-    print("\nНажмите [ Esc ] чтобы прервать процесс поиска\n")
+    service = None
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": "not found"})
+            return
+        self.send_json(200, {"status": "ok", "sessions": ["/".join(str(part) for part in key)
+                                                          for key in list(self.service.pool.sessions)]})
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            self.send_json(200, {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "Неверный JSON"}})
+            return
+        if isinstance(request, list):
+            self.send_json(200, [self.service.call(item) for item in request])
+        else:
+            self.send_json(200, self.service.call(request))
+
+
+def daemon_main(argv):
+    global cache, inventory
+    parser = argparse.ArgumentParser(description="Служба конфигурирования датчиков 415М-ДИ (JSON-RPC по HTTP)")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес для входящих подключений")
+    parser.add_argument("--port", type=int, default=8502, help="порт HTTP")
+    parser.add_argument("--sessions", type=int, default=32, help="наибольшее число открытых подключений к шинам")
+    parser.add_argument("--register-map", help="JSON файл карты регистров")
+    cli_options(parser)
+    args = parser.parse_args(argv)
+    if args.register_map:
+        load_register_map(args.register_map)
+    if args.metrics:
+        enable_metrics()
+    if args.capture:
+        enable_capture(args.capture)
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    cache = DiscoveryCache()
+    inventory = Inventory.load()
+    watch_abort(esc=False)
+    RpcHandler.service = ConfigService(args.sessions)
+    server = ThreadingHTTPServer((args.host, args.port), type("RpcHandler", (RpcHandler, BaseHTTPRequestHandler), {}))
+    border_print("Служба запущена на http://{0}:{1}/".format(args.host, args.port), "#")
     try:
-        keyboard.wait("esc")
-        port_search = False
-    except KeyError:
-        port_search = False
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        RpcHandler.service.pool.close_all()
+        disable_capture()
+        inventory.save()
+        if args.metrics:
+            metrics.save(args.metrics)
+    return 0
 
 
 def main():
-    global port_obj, sock, port_search
+    global port_obj, sock, pool, cache, inventory
+    pool = SessionPool()
+    cache = DiscoveryCache()
+    inventory = Inventory.load()
+    watch_abort()
     border_print("КОНФИГУРАТОР ДАТЧИКА ДАВЛЕНИЯ 415М-ДИ", "~", "|")
     mode = get_int(message="\nВыберите способ подключения и нажмите [ Ввод ]:"
                            "\n\t1 - Modbus RTU (через COM порт)"
@@ -442,7 +3739,8 @@ def main():
     if mode is None or mode == "quit":
         pass
     elif mode == 1:
-        ports = list_ports.comports()
+        from serial.tools import list_ports
+        ports = remember_adapters(list_ports.comports())
         str_ports = ["СПИСОК ДОСТУПНЫХ ПОРТОB:"]
         for port in ports:
             str_ports.append(str(port))
@@ -454,36 +3752,47 @@ def main():
                            name="номер COM порта", minimum=1, maximum=4096, zero_exit=True)
             if port == "quit":
                 break
-            port_obj = Port(port)
-            if port_obj.check_ports():
+            with abort.running():
+                session = pool.rtu(port)
+            if session is not None:
+                port_obj = session.transport
                 while True:
                     slave = get_int("\nВведите адрес датчика давления и нажмите [ Ввод ]"
                                     "\n\t(пустое поле для автоматического поиска, 0 - выход из программы): ",
                                     name="адрес датчика давления", minimum=1, maximum=247, zero_exit=True)
                     if slave == "quit":
                         break
-                    device_obj = Device(port_obj, slave)
+                    with abort.running():
+                        device_obj = session.device_for(slave)
+                        if not device_obj.check_connect() and port_obj.autodetect([slave] if slave else [1]):
+                            session.device = None
+                            device_obj = session.device_for(slave)
                     if device_obj.check_connect():
                         new_address = get_int("\nВведите новый адрес датчика давления и нажмите [ Ввод ]"
                                               "\n\t(пустое поле или 0 - оставить прежний): ",
                                               name="адрес датчика давления", minimum=1, maximum=247)
-                        device_obj.write_slave(new_address)
+                        with abort.running():
+                            device_obj.write_slave(new_address)
                     if not prog_start == get_bool():
                         break
-                    else:
-                        port_obj.close()
-                        port_obj = Port(port)
-                        if not port_obj.check_ports():
-                            break
+                    elif not session.check():
+                        break
                 break
     else:
         while prog_start:
             host = get_host()
             if host == "quit":
                 break
-            port = get_int("\nВведите номер порта  и нажмите [ Ввод ]"
-                           "\n\t(пустое поле для ввода диапазона, 0 - выход из программы): ",
-                           name="номер порта", minimum=1, maximum=65535, zero_exit=True)
+            if "/" in host:
+                gateway = find_gateway(host)
+                if gateway is None:
+                    continue
+                host, port = gateway
+            else:
+                port = get_int("\nВведите номер порта  и нажмите [ Ввод ]"
+                               "\n\t(пустое поле для ввода диапазона, 0 - выход из программы): ",
+                               name="номер порта", minimum=1, maximum=65535, zero_exit=True)
+            session = None
             try:
                 if port is None:
                     start_range = get_int("\nВведите начало диапазона и нажмите [ Ввод ]"
@@ -498,51 +3807,29 @@ def main():
                     if end_range is None or end_range == "quit":
                         break
                     ports = range(start_range, end_range+1)
-                    thread1 = Thread(target=wait_esc, daemon=True)
-                    thread1.start()
-                    print("\nПробуем подключиться к порту: ", end="")
-                    cnt_ports = 0
-                    port_search = True
-                    for port in ports:
-                        if not port_search:
-                            break
-                        cnt_ports += 1
-                        print(str(port), end="")
-                        print("\b" * len(str(port)), end="", flush=True)
-
-                        sock = Sock(host, port, test=True)
-                        if sock.check_connect():
-                            while True:
-                                slave = get_int("\nВведите адрес датчика давления и нажмите [ Ввод ]"
-                                                "\n\t(пустое поле для автоматического поиска, "
-                                                "0 - выход из программы): ",
-                                                name="адрес датчика давления", minimum=1, maximum=247, zero_exit=True)
-                                if slave == "quit":
-                                    prog_start = False
-                                    break
-                                device_tcp = TcpDevice(host, port, slave)
-                                if device_tcp.check_connect():
-                                    new_address = get_int("\nВведите новый адрес датчика давления и нажмите [ Ввод ]"
-                                                          "\n\t(пустое поле или 0 - оставить прежний): ",
-                                                          name="адрес датчика давления", minimum=1, maximum=247)
-                                    device_tcp.write_slave(new_address)
-                                if not prog_start == get_bool():
-                                    prog_start = False
-                                    break
-                            sock = None
-                            break
-                    if cnt_ports == len(ports):
-                        cnt_ports = 0
-                        print()
+                    print("\nНажмите [ {0} ] чтобы прервать процесс поиска\n".format(abort.key))
+                    print("\nИщем открытые порты в диапазоне {0}-{1}".format(start_range, end_range))
+                    with abort.running():
+                        # Сначала проверяем порты, найденные на этом хосте раньше
+                        open_ports = scan_ports(host, [p for p in cache.ports(host) if p in ports])
+                        if not open_ports:
+                            open_ports = scan_ports(host, ports, stop=abort.is_set,
+                                                    on_open=lambda p: print("Открыт порт", p, flush=True))
+                    cache.add_ports(host, open_ports)
+                    if not open_ports:
                         border_print("Подключиться к порту в заданном диапазоне не удалось", "!")
                         continue
-                    break
+                    port = open_ports[0]
+                    session = pool.tcp(host, port)
                 elif port == "quit":
                     break
                 else:
-                    sock = Sock(host, port)
+                    session = pool.tcp(host, port)
+                    if session is not None:
+                        cache.add_ports(host, [port])
             finally:
-                if sock is not None and sock.check_connect():
+                sock = session.transport if session is not None else None
+                if session is not None:
                     while True:
                         slave = get_int("\nВведите адрес датчика давления и нажмите [ Ввод ]"
                                         "\n\t(пустое поле для автоматического поиска, 0 - выход из программы): ",
@@ -550,17 +3837,47 @@ def main():
                         if slave == "quit":
                             prog_start = False
                             break
-                        device_tcp = TcpDevice(host, port, slave)
+                        with abort.running():
+                            device_tcp = session.device_for(slave)
                         if device_tcp.check_connect():
                             new_address = get_int("\nВведите новый адрес датчика давления и нажмите [ Ввод ]"
                                                   "\n\t(пустое поле или 0 - оставить прежний): ",
                                                   name="адрес датчика давления", minimum=1, maximum=247)
-                            device_tcp.write_slave(new_address)
+                            with abort.running():
+                                device_tcp.write_slave(new_address)
                         if not prog_start == get_bool():
                             prog_start = False
                             break
     programm_exit()
 
 
+COMMANDS = OrderedDict([
+    ("scan", (scan_main, "поиск датчиков на шине: scan tcp|rtu endpoint")),
+    ("readdress", (readdress_main, "переадресация: readdress tcp|rtu endpoint address new_address")),
+    ("poll", (poll_main, "непрерывный опрос: poll tcp://host:port/1,2 --register-map map.json -o samples.csv")),
+    ("push", (push_main, "рассылка профиля: push profile.json tcp://host:port/1,2 "
+                         "или push profile.json -m targets.csv")),
+    ("batch", (batch_main, "пакетная переадресация по манифесту: batch manifest.csv")),
+    ("daemon", (daemon_main, "служба JSON-RPC: daemon --port 8502")),
+])
+
+
+def cli(argv):
+    """
+    Подкоманды выполняются без интерактивного меню, без аргументов запускается меню.
+    Первый аргумент - не подкоманда: как и раньше, это манифест пакетной переадресации
+    """
+    if not argv:
+        main()
+        return 0
+    if argv[0] in ("-h", "--help"):
+        border_print(["ПОДКОМАНДЫ (main.py подкоманда -h - подробнее):"] +
+                     ["{0} - {1}".format(name, description) for name, (_, description) in COMMANDS.items()], "~", "|")
+        return 0
+    if argv[0] in COMMANDS:
+        return COMMANDS[argv[0]][0](argv[1:])
+    return batch_main(argv)
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(cli(sys.argv[1:]))
@@ -0,0 +1,632 @@
+# coding: utf-8
+# Проверки конфигуратора 415М-ДИ на имитаторах датчиков (см. benchmark.py)
+
+import signal
+import threading
+import pytest
+import main
+
+
+@pytest.fixture
+def cli_state(tmp_path, monkeypatch):
+    """
+    Подкоманды (main.cli) заменяют глобальные pool, cache, inventory, metrics и capture, дополняют карту регистров
+    и ставят свой обработчик SIGINT - после проверки все возвращаем
+    """
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(main, "REGISTER_MAP", list(main.REGISTER_MAP))
+    for name in ("pool", "cache", "inventory", "metrics", "capture"):
+        monkeypatch.setattr(main, name, None)
+    monkeypatch.setattr(main.abort, "key", main.abort.key)
+    handler = signal.getsignal(signal.SIGINT)
+    yield tmp_path
+    signal.signal(signal.SIGINT, handler)
+
+
+def test_capture_flushes_full_buffer(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    capture = main.FrameCapture(path, buffer_size=1024)
+    frames = [bytes([num % 256]) * 12 for num in range(200)]
+    worker = threading.Thread(target=lambda: [capture.record("tcp://gw:502", main.CAPTURE_TX, frame)
+                                              for frame in frames], daemon=True)
+    worker.start()
+    worker.join(5.0)
+    assert not worker.is_alive()
+    capture.close()
+    assert [(kind, label, frame) for _, kind, label, frame in main.read_capture(path)] == \
+        [(main.CAPTURE_TX, "tcp://gw:502", frame) for frame in frames]
+
+
+def test_capture_channels_are_not_reused(tmp_path):
+    import struct
+    path = str(tmp_path / "capture.bin")
+    capture = main.FrameCapture(path)
+    for num in range(300):
+        label = "tcp://h{0}:502".format(num)
+        capture.record(label, main.CAPTURE_TX, b"\x00\x01\x00\x00\x00\x02\x01\x03")
+        capture.record(label, main.CAPTURE_RX, b"\x00\x01\x00\x00\x00\x03\x01\x03" + bytes([num % 256]))
+    capture.close()
+    frames = main.read_capture(path)
+    assert [label for _, _, label, _ in frames] == ["tcp://h{0}:502".format(num // 2) for num in range(600)]
+    replay = main.CaptureReplay(path, "tcp://h0:502", speed=0)
+    assert replay.respond(b"\x00\x07\x00\x00\x00\x02\x01\x03")[0][-1] == 0
+    # Файлы прежнего формата с 8-битным номером канала читаются
+    old = str(tmp_path / "old.bin")
+    with open(old, "wb") as file:
+        file.write(b"415C" + struct.pack("<BBHQ", main.CAPTURE_CHANNEL, 0, 3, 0) + b"gw1" +
+                   struct.pack("<BBHQ", main.CAPTURE_TX, 0, 2, 10 ** 9) + b"\x01\x03")
+    assert main.read_capture(old) == [(1.0, main.CAPTURE_TX, "gw1", b"\x01\x03")]
+
+
+def tcp_simulator(slaves):
+    import benchmark
+    return benchmark.TcpSimulator(benchmark.SensorBank(slaves))
+
+
+def test_sock_connect_timeout_follows_link_rtt(monkeypatch):
+    rtt = main.connect_rtt("192.0.2.7")
+    for _ in range(8):
+        rtt.sample(0.6)
+    timeouts = []
+    monkeypatch.setattr(main.Sock, "connect_ex", lambda self, address: timeouts.append(self.gettimeout()) or 0)
+    sock = main.Sock("192.0.2.7", 502)
+    sock.close()
+    assert sock.check_connect() and timeouts[0] > 0.6
+
+
+def test_session_scheduler_created_once():
+    sim = tcp_simulator([1, 2])
+    pool = main.SessionPool()
+    try:
+        session = pool.tcp(sim.host, sim.port)
+        barrier = threading.Barrier(4)
+        schedulers = []
+
+        def get_scheduler():
+            barrier.wait()
+            schedulers.append(session.scheduler())
+
+        workers = [threading.Thread(target=get_scheduler) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert len(set(map(id, schedulers))) == 1
+        assert schedulers[0].masters[0] is session.device
+    finally:
+        pool.close_all()
+        sim.stop()
+
+
+def test_session_pool_one_session_per_key():
+    sim = tcp_simulator([1])
+    pool = main.SessionPool()
+    try:
+        barrier = threading.Barrier(4)
+        sessions = []
+
+        def get_session():
+            barrier.wait()
+            sessions.append(pool.tcp(sim.host, sim.port))
+
+        workers = [threading.Thread(target=get_session) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert len(set(map(id, sessions))) == 1
+        assert list(pool.sessions) == [("tcp", sim.host, sim.port)]
+    finally:
+        pool.close_all()
+        sim.stop()
+    assert sessions[0].transport.fileno() == -1
+
+
+def test_rpc_discover_network():
+    sim = tcp_simulator([1])
+    service = main.ConfigService()
+    try:
+        for network in ("127.0.0.0/30", ["127.0.0.0/30"]):
+            response = service.call({"jsonrpc": "2.0", "id": 1, "method": "discover",
+                                     "params": {"network": network, "ports": [sim.port]}})
+            assert response["result"] == [{"host": "127.0.0.1", "port": sim.port, "status": "sensor"}]
+    finally:
+        service.pool.close_all()
+        sim.stop()
+
+
+def test_rpc_rejects_bad_params(monkeypatch):
+    service = main.ConfigService()
+    bad = [("discover", {"slaves": 5}), ("discover", {"network": "127.0.0.0/30", "ports": 5}),
+           ("discover", {"network": "127.0.0.0/30", "ports": [70000]}), ("discover", {"network": "nowhere"}),
+           ("poll", {"endpoint": "127.0.0.1:1", "slaves": [1], "interval": [1]}),
+           ("read_config", {"endpoint": "127.0.0.1:1", "slave": 1, "fields": 5}),
+           ("read_config", {"endpoint": "127.0.0.1:70000", "slave": 1})]
+    for method, params in bad:
+        response = service.call({"jsonrpc": "2.0", "id": 1, "method": method, "params": params})
+        assert response["error"]["code"] == -32602, (method, params, response)
+    monkeypatch.setitem(service.methods, "inventory", lambda params, timing: 1 / 0)
+    response = service.call({"jsonrpc": "2.0", "id": 2, "method": "inventory", "params": {}})
+    assert response["id"] == 2 and response["error"]["code"] == -32603
+
+
+def test_find_gateway_validates_ports(tmp_path, monkeypatch):
+    import builtins
+    sim = tcp_simulator([1])
+    answers = iter(["70000", "abc", "0", str(sim.port)])
+    monkeypatch.setattr(builtins, "input", lambda message="": next(answers))
+    monkeypatch.setattr(main, "cache", main.DiscoveryCache(str(tmp_path / "cache.json")))
+    try:
+        assert main.find_gateway("127.0.0.1/32") == ("127.0.0.1", sim.port)
+    finally:
+        sim.stop()
+    # Подсеть /8 - без подтверждения поиск не начинается, адреса перебираются без построения списка
+    answers = iter(["502", "нет"])
+    assert main.find_gateway("10.0.0.0/8") is None
+    scanner = main.GatewayScanner(["10.0.0.0/8"], [502, 503])
+    targets = scanner.targets()
+    assert [next(targets) for _ in range(3)] == [("10.0.0.1", 502), ("10.0.0.1", 503), ("10.0.0.2", 502)]
+    assert scanner.size() == 2 ** 25
+
+
+class DroppingGateway(object):
+    """
+    Шлюз, который принимает подключение, читает один запрос и закрывает соединение
+    """
+    def __init__(self):
+        import socket
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.host, self.port = self.server.getsockname()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            client.settimeout(2.0)
+            try:
+                client.recv(256)
+            except OSError:
+                pass
+            client.close()
+
+    def stop(self):
+        self.server.close()
+
+
+def test_batch_records_dropped_connection(tmp_path):
+    gateway = DroppingGateway()
+    endpoint = "{0}:{1}".format(gateway.host, gateway.port)
+    manifest = [{"row": 1, "transport": "tcp", "endpoint": endpoint, "address": 1, "new_address": 2},
+                {"row": 2, "transport": "tcp", "endpoint": endpoint, "address": 3, "new_address": 4}]
+    result_path = str(tmp_path / "results.csv")
+    try:
+        statuses = main.batch_readdress(manifest, result_path)
+    finally:
+        gateway.stop()
+    assert sum(statuses.values()) == 2
+    assert set(statuses) <= {"error", "not_found", "port_failed"}
+    with open(result_path, encoding="utf-8") as file:
+        assert len(file.read().splitlines()) == 3
+
+
+def test_batch_groups_aliased_endpoints(tmp_path):
+    import benchmark
+    bank = benchmark.SensorBank([1, 2, 3, 4, 5, 6])
+    sim = benchmark.TcpSimulator(bank)
+    # Один шлюз в двух написаниях: без общей очереди два потока делят одно устройство и путают датчики
+    aliases = ["{0}:{1}".format(sim.host, sim.port), " {0}:0{1}".format(sim.host, sim.port)]
+    manifest = [{"row": num, "transport": "tcp", "endpoint": aliases[num % 2],
+                 "address": num, "new_address": num + 10} for num in range(1, 7)]
+    result_path = str(tmp_path / "results.csv")
+    try:
+        statuses = main.batch_readdress(manifest, result_path)
+    finally:
+        sim.stop()
+    assert statuses == {"ok": 6}
+    assert bank.sensors() == [11, 12, 13, 14, 15, 16]
+
+
+def test_batch_does_not_hook_keyboard(cli_state, tmp_path, monkeypatch, capsys):
+    import sys
+    import types
+    hotkeys = []
+    monkeypatch.setitem(sys.modules, "keyboard", types.SimpleNamespace(add_hotkey=lambda *args, **kwargs:
+                                                                       hotkeys.append(args)))
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("transport,endpoint,address,new_address\ntcp,127.0.0.1:1,1,2\n", encoding="utf-8")
+    main.batch_main([str(manifest), "-o", str(tmp_path / "results.csv")])
+    assert not hotkeys and "Esc" not in capsys.readouterr().out
+
+
+class MalformedGateway(DroppingGateway):
+    """
+    Шлюз с датчиком по адресу slave. На первый запрос первого подключения отвечает кадром
+    с длиной MBAP 0, дальше отвечает правильно; остальные адреса молчат
+    """
+    def __init__(self, slave):
+        self.slave = slave
+        self.connections = 0
+        super(MalformedGateway, self).__init__()
+
+    def run(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.serve, args=(client, self.connections == 1), daemon=True).start()
+
+    def serve(self, client, malformed):
+        import struct
+        buf = b""
+        with client:
+            while True:
+                try:
+                    data = client.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+                while len(buf) >= 12:
+                    tid, _, _, unit = struct.unpack(">HHHB", buf[:7])
+                    buf = buf[12:]
+                    try:
+                        if malformed:
+                            malformed = False
+                            client.sendall(struct.pack(">HHH", tid, 0, 0) + b"\x05\x03\x02\x00")
+                        elif unit == self.slave:
+                            client.sendall(struct.pack(">HHHBBBH", tid, 0, 5, unit, 3, 2, unit))
+                    except OSError:
+                        return
+
+
+def test_discovery_survives_malformed_mbap():
+    gateway = MalformedGateway(5)
+    try:
+        device = main.TcpDevice(gateway.host, gateway.port)
+        assert device.slaves == [5]
+        assert gateway.connections >= 2
+        device.close()
+    finally:
+        gateway.stop()
+
+
+def test_scan_finds_sensor_missing_from_cache(tmp_path, monkeypatch):
+    import benchmark
+    bank = benchmark.SensorBank([1, 2])
+    sim = benchmark.TcpSimulator(bank)
+    monkeypatch.setattr(main, "cache", main.DiscoveryCache(str(tmp_path / "cache.json")))
+    monkeypatch.setattr(main, "inventory", None)
+    try:
+        main.cache.add_slaves(("tcp", sim.host, sim.port), [1, 2])
+        bank.add_sensor(30)
+        device = main.TcpDevice(sim.host, sim.port)
+        assert device.slaves == [1, 2, 30]
+        device.close()
+    finally:
+        sim.stop()
+
+
+def test_subcommand_and_rpc_metrics(cli_state, tmp_path, monkeypatch):
+    sim = tcp_simulator([1, 2])
+    output = tmp_path / "metrics.prom"
+    try:
+        assert main.cli(["readdress", "tcp", "{0}:{1}".format(sim.host, sim.port), "2", "5",
+                         "--metrics", str(output)]) == 0
+    finally:
+        sim.stop()
+    assert 'modbus_transactions_total{{bus="tcp://{0}:{1}",slave="2",function="3",outcome="ok"}}'.format(
+        sim.host, sim.port) in output.read_text(encoding="utf-8")
+    service = main.ConfigService()
+    monkeypatch.setattr(main, "metrics", None)
+    assert service.call({"jsonrpc": "2.0", "id": 1, "method": "metrics"})["error"]["code"] == -32002
+    assert service.call({"jsonrpc": "2.0", "id": 2, "method": "metrics", "params": {"enable": True}})["result"] == []
+    main.metrics.record("tcp://gw:502", 1, 3, 0.004, "ok")
+    series = service.call({"jsonrpc": "2.0", "id": 3, "method": "metrics"})["result"]
+    assert series[0]["outcomes"] == {"ok": 1} and series[0]["buckets"]["0.005"] == 1
+    request = {"jsonrpc": "2.0", "id": 4, "method": "metrics", "params": {"format": "prometheus"}}
+    text = service.call(request)["result"]
+    assert 'modbus_latency_seconds_bucket{bus="tcp://gw:502",slave="1",function="3",le="+Inf"} 1' in text
+
+
+def test_poll_subcommand(cli_state, tmp_path):
+    import json
+    register_map = tmp_path / "map.json"
+    register_map.write_text(json.dumps([["pressure", "input", 0, "f"]]), encoding="utf-8")
+    output = tmp_path / "samples.csv"
+    sim = tcp_simulator([1, 2])
+    try:
+        code = main.cli(["poll", "tcp://{0}:{1}/1,2".format(sim.host, sim.port), "--register-map", str(register_map),
+                         "--interval", "0.05", "--duration", "0.5", "-o", str(output)])
+    finally:
+        sim.stop()
+    assert code == 0
+    rows = output.read_text(encoding="utf-8").splitlines()
+    assert rows[0] == "time,bus,slave,value" and len(rows) > 4
+
+
+def test_poll_subcommand_missing_field(cli_state, capsys):
+    assert main.cli(["poll", "tcp://127.0.0.1:1/1", "--duration", "0.1"]) == 1
+    assert "pressure" in capsys.readouterr().out
+
+
+def test_push_subcommand(cli_state, tmp_path):
+    import csv
+    import json
+    import benchmark
+    register_map = tmp_path / "map.json"
+    register_map.write_text(json.dumps([["filter", "holding", 10, "H"], ["range_hi", "holding", 20, "f"]]),
+                            encoding="utf-8")
+    profile = tmp_path / "profile.json"
+    profile.write_text(json.dumps({"filter": 3, "range_hi": 1.5}), encoding="utf-8")
+    manifest = tmp_path / "targets.csv"
+    output = tmp_path / "results.csv"
+    bank = benchmark.SensorBank([1, 2])
+    sim = benchmark.TcpSimulator(bank)
+    endpoint = "{0}:{1}".format(sim.host, sim.port)
+    manifest.write_text("transport,endpoint,address\ntcp,{0},9\n".format(endpoint), encoding="utf-8")
+    try:
+        code = main.cli(["push", str(profile), "tcp://{0}/1,2".format(endpoint), "-m", str(manifest),
+                         "--register-map", str(register_map), "-o", str(output)])
+    finally:
+        sim.stop()
+    assert code == 1
+    with open(str(output), encoding="utf-8") as file:
+        statuses = {int(row["address"]): row["status"] for row in csv.DictReader(file)}
+    assert statuses == {1: "ok", 2: "ok", 9: "error"}
+    for slave in (1, 2):
+        assert bank.get_slave(slave).get_values("holding", 10, 1) == (3,)
+
+
+def test_push_rejects_profile_values_outside_format(cli_state, tmp_path, capsys):
+    import json
+    main.REGISTER_MAP += [("filter", "holding", 10, "H"), ("range_hi", "holding", 20, "f")]
+    profile = tmp_path / "profile.json"
+    for values in ({"filter": 70000}, {"filter": -1}, {"filter": 2.5}, {"filter": "3"}, {"filter": True},
+                   {"range_hi": 1e40}, [["filter", 3]]):
+        profile.write_text(json.dumps(values), encoding="utf-8")
+        with pytest.raises(ValueError):
+            main.load_profile(str(profile))
+    profile.write_text(json.dumps({"filter": 65535, "range_hi": 2}), encoding="utf-8")
+    assert main.profile_blocks(main.load_profile(str(profile))) == [(10, [65535]), (20, [16384, 0])]
+    profile.write_text(json.dumps({"filter": 70000}), encoding="utf-8")
+    assert main.cli(["push", str(profile), "tcp://127.0.0.1:1/1"]) == 1
+    assert "filter" in capsys.readouterr().out
+
+
+def test_port_probe_uses_cached_addresses(tmp_path, monkeypatch):
+    import os
+    import types
+    import benchmark
+    from serial.tools import list_ports
+    if os.name != "posix":
+        pytest.skip("имитатор RTU работает на псевдотерминалах")
+    # Датчик на адресе 7 и устройство на адресе 3, отвечающее кодом ошибки Modbus (нет регистра 249)
+    bank = benchmark.SensorBank([7])
+    bank.add_slave(3)
+    sim = benchmark.RtuSimulator(bank, 9600)
+    com_port = types.SimpleNamespace(device=sim.port_name, description="pty", serial_number=None)
+    monkeypatch.setattr(list_ports, "comports", lambda: [com_port])
+    monkeypatch.setattr(main, "cache", main.DiscoveryCache(str(tmp_path / "cache.json")))
+    monkeypatch.setattr(main, "detect_framings", lambda *args, **kwargs: pytest.fail("подбор скорости не нужен"))
+    try:
+        assert main.probe_com_ports([com_port]) == []
+        main.cache.add_slaves(("rtu", main.adapter_id(sim.port_name)), [3, 7])
+        assert [found for _, found, _ in main.probe_com_ports([com_port])] == [[3, 7]]
+        port = main.Port()
+        assert port.port == sim.port_name
+        port.close()
+    finally:
+        sim.stop()
+
+
+def test_port_detects_framing_on_all_adapters(tmp_path, monkeypatch):
+    import os
+    import types
+    import benchmark
+    from serial.tools import list_ports
+    if os.name != "posix":
+        pytest.skip("имитатор RTU работает на псевдотерминалах")
+    sims = [benchmark.RtuSimulator(benchmark.SensorBank([slave]), 38400, strict=True) for slave in (2, 1)]
+    monkeypatch.setattr(list_ports, "comports", lambda: [
+        types.SimpleNamespace(device=sim.port_name, description="pty", serial_number=None) for sim in sims])
+    monkeypatch.setattr(main, "cache", main.DiscoveryCache(str(tmp_path / "cache.json")))
+    try:
+        port = main.Port()
+        assert port.port == sims[1].port_name and port.baudrate == 38400
+        assert main.cache.framing(main.adapter_id(sims[0].port_name)) is None
+        assert main.cache.framing(main.adapter_id(sims[1].port_name))[0] == 38400
+        port.close()
+    finally:
+        for sim in sims:
+            sim.stop()
+
+
+def test_adapter_id_enumerates_ports_once(monkeypatch):
+    import types
+    from serial.tools import list_ports
+    calls = []
+
+    def comports():
+        calls.append(1)
+        return [types.SimpleNamespace(device="/dev/ttyUSB7", serial_number="A5XK3RJT")]
+
+    monkeypatch.setattr(list_ports, "comports", comports)
+    monkeypatch.setattr(main, "adapter_ids", {})
+    assert [main.adapter_id("/dev/ttyUSB7") for _ in range(5)] == ["A5XK3RJT"] * 5
+    assert [main.adapter_id("/dev/ttyS9") for _ in range(5)] == ["/dev/ttyS9"] * 5
+    assert len(calls) == 2
+    main.remember_adapters([types.SimpleNamespace(device="/dev/ttyUSB7", serial_number="B7")])
+    assert main.adapter_id("/dev/ttyUSB7") == "B7" and len(calls) == 2
+
+
+def test_rtt_estimator():
+    rtt = main.RttEstimator(0.25, 0.02, 1.0)
+    # До первого ответа таймаут удваивается, но не выше maximum
+    for expected in (0.5, 1.0, 1.0):
+        rtt.backoff()
+        assert rtt.timeout() == expected
+    rtt.sample(0.1)
+    assert rtt.timeout() == pytest.approx(0.1 + 4 * 0.05)
+    rtt.backoff()
+    assert rtt.timeout() == pytest.approx(0.3)
+    for _ in range(100):
+        rtt.sample(0.001)
+    assert rtt.timeout() == 0.02
+
+
+def test_plan_and_profile_blocks(monkeypatch):
+    fields = [("a", "holding", 0, "H"), ("b", "holding", 3, "f"), ("c", "holding", 20, "H"), ("d", "input", 0, "H")]
+    assert main.plan_blocks(fields) == [("holding", 0, 5), ("holding", 20, 1), ("input", 0, 1)]
+    assert main.plan_blocks(fields, max_gap=0) == [("holding", 0, 1), ("holding", 3, 2), ("holding", 20, 1),
+                                                   ("input", 0, 1)]
+    assert main.plan_blocks(fields, max_count=3) == [("holding", 0, 1), ("holding", 3, 2), ("holding", 20, 1),
+                                                     ("input", 0, 1)]
+    monkeypatch.setattr(main, "REGISTER_MAP", [("x", "holding", 30, "H"), ("y", "holding", 31, "h"),
+                                               ("z", "holding", 32, "I"), ("w", "holding", 40, "H")])
+    profile = {"w": 7, "z": 65537, "y": -2, "x": 1}
+    assert main.profile_blocks(profile) == [(30, [1, 65534, 1, 1]), (40, [7])]
+    assert main.profile_blocks(profile, max_count=3) == [(30, [1, 65534, 1]), (33, [1]), (40, [7])]
+
+
+def test_inventory_save_and_mmap_load(tmp_path):
+    path = str(tmp_path / "inventory.bin")
+    gateway, adapter = ("tcp", "10.0.0.5", 502), ("rtu", "A5XK3RJT")
+    inventory = main.Inventory(path)
+    inventory.seen(gateway, [1, 2, 3], config_hash=0xabc)
+    inventory.seen(adapter, [1], health=main.HEALTH_DUPLICATE)
+    assert inventory.move(gateway, 2, 7)
+    assert not inventory.move(gateway, 3, 7)
+    inventory.save()
+    loaded = main.Inventory.load(path)
+    assert len(loaded) == 3 and len(loaded.slave_column) == 3
+    assert [(record.endpoint, record.slave) for record in loaded.on_bus(gateway)] == [("10.0.0.5:502", 1),
+                                                                                     ("10.0.0.5:502", 7)]
+    assert loaded.find(gateway, 7).to_dict()["config_hash"] == "{0:016x}".format(0xabc)
+    assert loaded.taken(gateway, 7) and not loaded.taken(gateway, 2) and not loaded.taken(gateway, 3)
+    assert sorted(record.transport for record in loaded.with_address(1)) == ["rtu", "tcp"]
+    assert [record.slave for record in loaded.duplicates()] == [1]
+    assert loaded.duplicates()[0].to_dict()["health"] == main.HEALTH_NAMES[main.HEALTH_DUPLICATE]
+    assert loaded.free_addresses(gateway)[:2] == [2, 3]
+    with open(path, "r+b") as file:
+        file.write(b"XXXX")
+    assert len(main.Inventory.load(path)) == 0
+
+
+def test_ring_buffer_wraparound():
+    ring = main.RingBuffer(4)
+    for num in range(6):
+        ring.append(float(num), num + 1, num * 10.0)
+    assert ring.dropped == 2
+    times, slaves, values = ring.drain()
+    assert list(times) == [2.0, 3.0, 4.0, 5.0] and list(slaves) == [3, 4, 5, 6]
+    assert list(values) == [20.0, 30.0, 40.0, 50.0]
+    assert [len(column) for column in ring.drain()] == [0, 0, 0]
+    # Следующие отсчеты переходят через конец массивов
+    for num in range(6, 9):
+        ring.append(float(num), 1, 0.0)
+    assert list(ring.drain()[0]) == [6.0, 7.0, 8.0] and ring.dropped == 2
+
+
+class GatedMaster(object):
+    """
+    Подключение для GatewayScheduler: первая транзакция ждет gate, все транзакции записываются по порядку
+    """
+    def __init__(self):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.calls = []
+
+    def execute(self, slave, *args, **kwargs):
+        self.calls.append((slave,) + args[:2])
+        self.started.set()
+        self.gate.wait(5.0)
+        return (slave,)
+
+    def close(self):
+        pass
+
+
+def test_gateway_scheduler_priority_fairness_merging():
+    master = GatedMaster()
+    scheduler = main.GatewayScheduler([master])
+    try:
+        first = scheduler.submit(9, (main.mb_def.READ_HOLDING_REGISTERS, 249, 1))
+        assert master.started.wait(5.0)
+        # Пока шлюз занят: по три записи двум датчикам, чтение для опроса и два одинаковых чтения
+        writes = [scheduler.submit(slave, (main.mb_def.WRITE_SINGLE_REGISTER, 10 + num), {"output_value": num})
+                  for slave in (1, 2) for num in range(3)]
+        poll = scheduler.submit(3, (main.mb_def.READ_INPUT_REGISTERS, 0, 2), priority=main.PRIORITY_POLL)
+        reads = [scheduler.submit(4, (main.mb_def.READ_HOLDING_REGISTERS, 0, 4)) for _ in range(2)]
+        assert reads[0] is reads[1] and reads[0].waiters == 2 and scheduler.merged == 1
+        master.gate.set()
+        for transaction in [first, poll, reads[0]] + writes:
+            assert transaction.wait() == (transaction.slave,)
+    finally:
+        scheduler.close()
+    order = [call[:2] for call in master.calls]
+    assert order[:2] == [(9, main.mb_def.READ_HOLDING_REGISTERS), (3, main.mb_def.READ_INPUT_REGISTERS)]
+    # Внутри приоритета адреса чередуются, объединенное чтение выполнено один раз
+    assert [slave for slave, _ in order[2:]] == [1, 2, 4, 1, 2, 1, 2]
+    assert scheduler.executed == 9
+
+
+def test_metrics_export(tmp_path):
+    import json
+    import types
+    import socket
+    metrics = main.Metrics()
+    metrics.record("tcp://gw:502", 1, 3, 0.3, "timeout")
+    metrics.record("tcp://gw:502", 1, 3, 0.002, "ok")
+    metrics.record("tcp://gw:502", 1, 3, 5.0, "ok")
+
+    def silent(*args):
+        raise socket.timeout()
+
+    with pytest.raises(socket.timeout):
+        metrics.observe(types.SimpleNamespace(_host="gw", _port=502), silent, (2, 3, 249, 1), {})
+    text = metrics.prometheus()
+    labels = 'bus="tcp://gw:502",slave="1",function="3"'
+    assert 'modbus_transactions_total{{{0},outcome="timeout"}} 1'.format(labels) in text
+    assert "modbus_retries_total{{{0}}} 1".format(labels) in text
+    assert 'modbus_latency_seconds_bucket{{{0},le="0.0025"}} 1'.format(labels) in text
+    assert 'modbus_latency_seconds_bucket{{{0},le="0.5"}} 2'.format(labels) in text
+    assert 'modbus_latency_seconds_bucket{{{0},le="+Inf"}} 3'.format(labels) in text
+    assert 'slave="2",function="3",outcome="timeout"' in text
+    metrics.save(str(tmp_path / "metrics.prom"))
+    assert (tmp_path / "metrics.prom").read_text(encoding="utf-8") == text
+    metrics.save(str(tmp_path / "metrics.jsonl"))
+    lines = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert lines == metrics.to_list() and lines[0]["count"] == 3 and lines[0]["retries"] == 1
+
+
+def test_capture_replay_serves_recorded_gateway(cli_state, tmp_path):
+    path = str(tmp_path / "capture.bin")
+    sim = tcp_simulator([1])
+    main.enable_capture(path)
+    try:
+        device = main.TcpDevice(sim.host, sim.port, connect=False)
+        device.open()
+        recorded = device.execute(1, main.mb_def.READ_HOLDING_REGISTERS, 249, 1)
+        device.close()
+    finally:
+        main.disable_capture()
+        sim.stop()
+    replay = main.CaptureReplay(path, speed=0)
+    assert replay.tcp and replay.label == "tcp://{0}:{1}".format(sim.host, sim.port)
+    assert replay.respond(b"\x00\x09\x00\x00\x00\x06\x01\x03\x00\x00\x00\x01") == (None, 0.0)
+    gateway = main.ReplayGateway(replay)
+    try:
+        device = main.TcpDevice(gateway.host, gateway.port, connect=False)
+        device.open()
+        # Номер транзакции в ответе подставляется из запроса, поэтому ответ подходит и к повторному запросу
+        assert [device.execute(1, main.mb_def.READ_HOLDING_REGISTERS, 249, 1) for _ in range(2)] == [recorded] * 2
+        device.close()
+    finally:
+        gateway.stop()